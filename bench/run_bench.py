@@ -0,0 +1,223 @@
+"""
+Throughput benchmark for the provider pipeline against local stand-in servers,
+so it needs no credentials and spends no quota. Runs the same fan-out as
+main.py over synthetic documents for every batch size and concurrency level,
+and reports call latency percentiles, docs/sec and API calls per document.
+Providers run side by side as in main.py, so docs/sec is for the whole fan-out.
+
+    python bench/run_bench.py --batch-sizes 50 200 --concurrency 1 4 16
+    python bench/run_bench.py --json bench.json --baseline previous.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from stand_ins import StandInConfig, start_stand_ins
+from cache import configure_cache
+from engine import FanOutEngine
+from local_detector import FIRST_NAMES, LAST_NAMES
+from pii_services import create_service, AZURE_MAX_BATCH_SIZE, GCP_CHUNK_SIZE
+from rate_limit import configure_limiter
+from batcher import DEFAULT_BATCH_LIMITS, configure_batch_size
+from taxonomy import SCORED_TYPES, provider_labels
+
+# Documents per provider call, as main.py sends them
+CHUNK_SIZES = {
+    "azure": AZURE_MAX_BATCH_SIZE,
+    "gcp": GCP_CHUNK_SIZE,
+    # Comprehend packs short documents into one text per request
+    "aws": DEFAULT_BATCH_LIMITS["aws"].max_count,
+}
+GCP_INFO_TYPES = provider_labels('gcp', SCORED_TYPES)
+
+TEMPLATES = [
+    "Hi {first}, your statement for account {account} is ready. Contact {email} with any questions.",
+    "Ticket opened by {first} {last} on {date}: cannot log in from {street} Main Street.",
+    "Customer {first} {last} called from {phone} about a card payment on {date}.",
+    "Please wire the funds before {date}. Regards, {first} {last}",
+    "The quarterly report is attached, no changes since the last review.",
+]
+
+
+def make_documents(count, chars, seed=0):
+    """Deterministic synthetic documents of about `chars` characters with PII sprinkled in."""
+    rng = random.Random(seed)
+    documents = []
+    for _ in range(count):
+        sentences = []
+        while sum(len(sentence) + 1 for sentence in sentences) < chars:
+            first, last = rng.choice(FIRST_NAMES).title(), rng.choice(LAST_NAMES).title()
+            sentences.append(rng.choice(TEMPLATES).format(
+                first=first, last=last,
+                email=f"{first.lower()}.{last.lower()}@example.com",
+                phone=f"555-{rng.randint(100, 999)}-{rng.randint(1000, 9999)}",
+                date=f"{rng.randint(1, 12)}/{rng.randint(1, 28)}/2023",
+                account=rng.randint(10_000_000, 99_999_999),
+                street=rng.randint(1, 9999),
+            ))
+        documents.append(" ".join(sentences))
+    return documents
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def timed(fn, latencies):
+    def call(chunk):
+        start = time.perf_counter()
+        try:
+            return fn(chunk)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    return call
+
+
+def provider_calls(providers):
+    services = {provider: create_service(provider) for provider in providers}
+    calls = {}
+    for provider, service in services.items():
+        if service.requires_info_types:
+            fn = lambda docs, service=service: service.recognize_spans(docs, GCP_INFO_TYPES)
+        else:
+            fn = service.recognize_spans
+        calls[provider] = (fn, CHUNK_SIZES.get(provider, 1))
+    return services, calls
+
+
+def run_config(documents, providers, servers, batch_size, concurrency, rate, target_latency=None):
+    """Runs every document through the providers once and returns one result per provider."""
+    for provider in providers:
+        configure_limiter(provider, rate=rate, burst=rate)
+        configure_batch_size(provider, target_latency=target_latency)
+        servers[provider].reset_stats()
+    services, calls = provider_calls(providers)
+    latencies = {provider: [] for provider in providers}
+    calls = {provider: (timed(fn, latencies[provider]), size) for provider, (fn, size) in calls.items()}
+    failed = {provider: 0 for provider in providers}
+
+    engine = FanOutEngine({provider: concurrency for provider in providers})
+    start = time.perf_counter()
+    try:
+        for batch_start in range(0, len(documents), batch_size):
+            results = engine.run(documents[batch_start:batch_start + batch_size], calls)
+            for provider, provider_results in results.items():
+                failed[provider] += sum(isinstance(result, Exception) for result in provider_results)
+    finally:
+        engine.shutdown()
+        for service in services.values():
+            service.close()
+    elapsed = time.perf_counter() - start
+
+    results = []
+    for provider in providers:
+        stats = servers[provider].stats
+        results.append({
+            "provider": provider,
+            "batch_size": batch_size,
+            "concurrency": concurrency,
+            "documents": len(documents),
+            "seconds": elapsed,
+            "docs_per_sec": len(documents) / elapsed,
+            "p50_ms": percentile(latencies[provider], 50) * 1000,
+            "p95_ms": percentile(latencies[provider], 95) * 1000,
+            "p99_ms": percentile(latencies[provider], 99) * 1000,
+            "calls_per_doc": stats["requests"] / len(documents),
+            "throttled": stats["throttled"],
+            "server_errors": stats["error"],
+            "failed_docs": failed[provider],
+        })
+    return results
+
+
+def print_results(results):
+    header = f"{'provider':<8} {'batch':>6} {'conc':>5} {'docs/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'calls/doc':>10} {'429s':>6} {'5xx':>5} {'failed':>7}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['provider']:<8} {r['batch_size']:>6} {r['concurrency']:>5} {r['docs_per_sec']:>9.1f} "
+              f"{r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['calls_per_doc']:>10.3f} "
+              f"{r['throttled']:>6} {r['server_errors']:>5} {r['failed_docs']:>7}")
+
+
+def regressions(results, baseline, tolerance):
+    """Configurations whose docs/sec fell more than `tolerance` below the baseline run."""
+    previous = {(r["provider"], r["batch_size"], r["concurrency"]): r["docs_per_sec"] for r in baseline}
+    slower = []
+    for r in results:
+        before = previous.get((r["provider"], r["batch_size"], r["concurrency"]))
+        if before and r["docs_per_sec"] < before * (1 - tolerance):
+            slower.append((r, before))
+    return slower
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the PII pipeline against local stand-in providers")
+    parser.add_argument("--providers", nargs="+", default=["azure", "gcp", "aws"], choices=["azure", "gcp", "aws"])
+    parser.add_argument("--documents", type=int, default=500, help="Synthetic documents per configuration")
+    parser.add_argument("--doc-chars", type=int, default=600, help="Approximate length of each document")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[50, 200], help="Rows per engine batch, like main.py --batch-size")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="In-flight requests per provider")
+    parser.add_argument("--latency-ms", type=float, default=50, help="Stand-in latency per request")
+    parser.add_argument("--per-document-ms", type=float, default=2, help="Extra stand-in latency per document in a request")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Random +/- fraction applied to the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail with a 5xx")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests that are throttled")
+    parser.add_argument("--retry-after", type=float, default=1, help="Retry-After seconds sent with throttled responses")
+    parser.add_argument("--target-latency-ms", type=float, default=None,
+                        help="Let the request size adapt to keep calls under this latency, instead of filling every request")
+    parser.add_argument("--rate", type=float, default=1000, help="Client-side limiter rate per provider, high by default so the stand-ins set the pace")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run to compare docs/sec against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed docs/sec drop against the baseline before failing")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    configure_cache(None)
+
+    config = StandInConfig(
+        latency=args.latency_ms / 1000, per_document_latency=args.per_document_ms / 1000, jitter=args.jitter,
+        error_rate=args.error_rate, throttle_rate=args.throttle_rate, retry_after=args.retry_after, seed=args.seed
+    )
+    servers = start_stand_ins(args.providers, config)
+    documents = make_documents(args.documents, args.doc_chars, args.seed)
+
+    results = []
+    try:
+        for batch_size in args.batch_sizes:
+            for concurrency in args.concurrency:
+                results.extend(run_config(documents, args.providers, servers, batch_size, concurrency, args.rate,
+                                          args.target_latency_ms / 1000 if args.target_latency_ms else None))
+    finally:
+        for server in servers.values():
+            server.stop()
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(results, json.load(f), args.tolerance)
+        for r, before in slower:
+            print(f"Regression: {r['provider']} batch {r['batch_size']} concurrency {r['concurrency']}: "
+                  f"{r['docs_per_sec']:.1f} docs/s, was {before:.1f}")
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
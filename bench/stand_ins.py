@@ -0,0 +1,305 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import Counter
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from local_detector import LocalPIIDetector
+
+# Local detector labels (DLP names) as each provider would report them
+AZURE_CATEGORIES = {
+    "PERSON_NAME": "Person",
+    "EMAIL_ADDRESS": "Email",
+    "PHONE_NUMBER": "PhoneNumber",
+    "US_SOCIAL_SECURITY_NUMBER": "USSocialSecurityNumber",
+    "US_INDIVIDUAL_TAXPAYER_IDENTIFICATION_NUMBER": "USIndividualTaxpayerIdentification",
+    "CREDIT_CARD_NUMBER": "CreditCardNumber",
+    "DATE": "DateTime",
+    "STREET_ADDRESS": "Address",
+}
+# Categories a request filters on, where they differ from the category returned
+AZURE_REQUEST_CATEGORIES = {"DateTime": "Date"}
+
+COMPREHEND_TYPES = {
+    "PERSON_NAME": "NAME",
+    "EMAIL_ADDRESS": "EMAIL",
+    "PHONE_NUMBER": "PHONE",
+    "US_SOCIAL_SECURITY_NUMBER": "SSN",
+    "US_INDIVIDUAL_TAXPAYER_IDENTIFICATION_NUMBER": "SSN",
+    "CREDIT_CARD_NUMBER": "CREDIT_DEBIT_NUMBER",
+    "DATE": "DATE_TIME",
+    "STREET_ADDRESS": "ADDRESS",
+}
+
+
+def azure_request_category(label):
+    category = AZURE_CATEGORIES[label]
+    return AZURE_REQUEST_CATEGORIES.get(category, category)
+
+
+def likelihood(score):
+    if score >= 0.85:
+        return "VERY_LIKELY"
+    if score >= 0.7:
+        return "LIKELY"
+    return "POSSIBLE"
+
+
+class StandInConfig:
+    """
+    How a stand-in behaves. Each request waits `latency` seconds plus
+    `per_document_latency` per document, scaled by a random factor within
+    `jitter`, then fails with a 5xx with probability `error_rate` or is
+    throttled (429 with Retry-After) with probability `throttle_rate`.
+    """
+
+    def __init__(self, latency=0.05, per_document_latency=0.002, jitter=0.2,
+                 error_rate=0.0, throttle_rate=0.0, retry_after=1, seed=0):
+        self.latency = latency
+        self.per_document_latency = per_document_latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def outcome(self, documents):
+        """Returns (delay in seconds, 'ok' | 'error' | 'throttled') for one request."""
+        with self.lock:
+            factor = self.random.uniform(1 - self.jitter, 1 + self.jitter)
+            roll = self.random.random()
+        delay = (self.latency + self.per_document_latency * documents) * factor
+        if roll < self.throttle_rate:
+            return delay, "throttled"
+        if roll < self.throttle_rate + self.error_rate:
+            return delay, "error"
+        return delay, "ok"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Shared request handling. Subclasses implement `documents` (the texts in a
+    request body), `respond` (the success body) and the error bodies in their
+    provider's wire format.
+    """
+    protocol_version = "HTTP/1.1"
+    throttle_status = 429
+    error_status = 503
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        texts = self.documents(body)
+        delay, outcome = self.server.config.outcome(len(texts))
+        time.sleep(delay)
+        self.server.record(outcome, len(texts))
+
+        if outcome == "throttled":
+            self.send_json(self.throttle_status, self.throttle_body(), {"Retry-After": str(self.server.config.retry_after)})
+        elif outcome == "error":
+            self.send_json(self.error_status, self.error_body())
+        else:
+            self.send_json(200, self.respond(body, texts))
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", self.content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AzureHandler(StandInHandler):
+    """Text Analytics PII recognition, both the 2023-04-01 analyze-text and the v3.1 routes."""
+    content_type = "application/json"
+
+    def documents(self, body):
+        documents = body["analysisInput"]["documents"] if "analysisInput" in body else body.get("documents", [])
+        return [document["text"] for document in documents]
+
+    def respond(self, body, texts):
+        documents = body["analysisInput"]["documents"] if "analysisInput" in body else body["documents"]
+        # The SDK sends categories_filter as piiCategories in the task parameters
+        wanted = body.get("parameters", {}).get("piiCategories")
+        results = []
+        for document in documents:
+            spans = [span for span in self.server.detector.detect(document["text"])
+                     if span["label"] in AZURE_CATEGORIES and (not wanted or azure_request_category(span["label"]) in wanted)]
+            results.append({
+                "id": document["id"],
+                "redactedText": document["text"],
+                "entities": [{
+                    "text": span["text"],
+                    "category": AZURE_CATEGORIES[span["label"]],
+                    "offset": span["start"],
+                    "length": span["end"] - span["start"],
+                    "confidenceScore": span["score"],
+                } for span in spans],
+                "warnings": [],
+            })
+        results = {"documents": results, "errors": [], "modelVersion": "2021-01-15"}
+        if "analysisInput" in body:
+            return {"kind": "PiiEntityRecognitionResults", "results": results}
+        return results
+
+    def throttle_body(self):
+        return {"error": {"code": "429", "message": "Rate limit is exceeded."}}
+
+    def error_body(self):
+        return {"error": {"code": "ServiceUnavailable", "message": "Stand-in error."}}
+
+
+class DLPHandler(StandInHandler):
+    """DLP content:inspect over REST, for plain values and single-column tables."""
+    content_type = "application/json"
+
+    def documents(self, body):
+        item = body.get("item", {})
+        if "table" in item:
+            return [row["values"][0].get("stringValue", "") for row in item["table"].get("rows", [])]
+        return [item.get("value", "")]
+
+    def respond(self, body, texts):
+        wanted = {info_type["name"] for info_type in body.get("inspectConfig", {}).get("infoTypes", [])}
+        is_table = "table" in body.get("item", {})
+        findings = []
+        for row, text in enumerate(texts):
+            for span in self.server.detector.detect(text, wanted or None):
+                byte_start = len(text[:span["start"]].encode("utf-8"))
+                location = {
+                    "byteRange": {"start": byte_start, "end": byte_start + len(span["text"].encode("utf-8"))},
+                    "codepointRange": {"start": span["start"], "end": span["end"]},
+                }
+                if is_table:
+                    location["contentLocations"] = [{"recordLocation": {"tableLocation": {"rowIndex": row}}}]
+                findings.append({
+                    "quote": span["text"],
+                    "infoType": {"name": span["label"]},
+                    "likelihood": likelihood(span["score"]),
+                    "location": location,
+                })
+        return {"result": {"findings": findings, "findingsTruncated": False}}
+
+    def throttle_body(self):
+        return {"error": {"code": 429, "message": "Quota exceeded.", "status": "RESOURCE_EXHAUSTED"}}
+
+    def error_body(self):
+        return {"error": {"code": 503, "message": "Stand-in error.", "status": "UNAVAILABLE"}}
+
+
+class ComprehendHandler(StandInHandler):
+    """Comprehend DetectPiiEntities over the JSON 1.1 protocol."""
+    content_type = "application/x-amz-json-1.1"
+    # Comprehend throttles with a 400 ThrottlingException rather than a 429
+    throttle_status = 400
+    error_status = 500
+
+    def documents(self, body):
+        return [body.get("Text", "")]
+
+    def respond(self, body, texts):
+        spans = [span for span in self.server.detector.detect(texts[0]) if span["label"] in COMPREHEND_TYPES]
+        return {"Entities": [{
+            "Score": span["score"],
+            "Type": COMPREHEND_TYPES[span["label"]],
+            "BeginOffset": span["start"],
+            "EndOffset": span["end"],
+        } for span in spans]}
+
+    def throttle_body(self):
+        return {"__type": "ThrottlingException", "message": "Rate exceeded"}
+
+    def error_body(self):
+        return {"__type": "InternalServerException", "message": "Stand-in error."}
+
+
+HANDLERS = {
+    "azure": AzureHandler,
+    "gcp": DLPHandler,
+    "aws": ComprehendHandler,
+}
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    A local stand-in for one provider's endpoint, served from a background
+    thread on a free port. Findings come from the local detector, so responses
+    have realistic entities and offsets. `stats` counts requests, documents and
+    their outcomes for the calls-per-document figures.
+    """
+    daemon_threads = True
+
+    def __init__(self, provider, config=None, host="127.0.0.1", port=0):
+        super().__init__((host, port), HANDLERS[provider])
+        self.provider = provider
+        self.config = config or StandInConfig()
+        self.detector = LocalPIIDetector()
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record(self, outcome, documents):
+        with self.stats_lock:
+            self.stats["requests"] += 1
+            self.stats["documents"] += documents
+            self.stats[outcome] += 1
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = Counter()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name=f"{self.provider}-stand-in", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def start_stand_ins(providers, config=None):
+    """
+    Starts a stand-in per provider and points the services at them through
+    their endpoint environment variables. Returns a dict of provider name to server.
+    """
+    servers = {provider: StandInServer(provider, config).start() for provider in providers}
+    if "azure" in servers:
+        os.environ["AZURE_ENDPOINT"] = servers["azure"].url
+        os.environ["AZURE_API_KEY"] = "stand-in"
+    if "gcp" in servers:
+        os.environ["DLP_ENDPOINT"] = servers["gcp"].url
+        os.environ.setdefault("GCP_PROJECT_ID", "stand-in")
+    if "aws" in servers:
+        os.environ["COMPREHEND_ENDPOINT_URL"] = servers["aws"].url
+        os.environ["AWS_ACCESS_KEY_ID"] = "stand-in"
+        os.environ["AWS_SECRET_ACCESS_KEY"] = "stand-in"
+    return servers
+
+
+if __name__ == "__main__":
+    # Serve the stand-ins until interrupted, e.g. to point main.py at them by hand
+    servers = start_stand_ins(HANDLERS)
+    for provider, server in servers.items():
+        print(f"{provider}: {server.url}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for server in servers.values():
+            server.stop()
@@ -26,42 +26,111 @@ from data_object import RedactionConfig
 from processors import Segmenter, Redactor
 from handler import redact
 
+# Shared rate limiter lives in src/
+sys.path.append(os.path.dirname(current_dir))
+from rate_limit import get_limiter
+from cache import get_cache, fetch_cached
+from batcher import PACK_SEPARATOR, get_batch_size, join_documents
+
 
 """
 Initialize Comprehend client. 
-Override the default boto3 client configuration to set retries and adaptive mode for adaptive rate limiting
+Override the default boto3 client configuration to turn retries off, the shared limiter retries and rate limits every call
 """
-def getComprehendClient(region_name='us-east-1'):
-    COMPREHEND_MAX_RETRIES = 100
-    CLIENT_MODE = 'adaptive'
+def getComprehendClient(region_name='us-east-1', thread_count=1):
+    COMPREHEND_MAX_RETRIES = 1
+    CLIENT_MODE = 'standard'
     comprehendClient = ComprehendClient(s3ol_access_point="Custom App", region_name=region_name,session_id="Custom Session", user_agent="Custom PII Redaction App",
-                                    endpoint_url=COMPREHEND_ENDPOINT_URL, pii_redaction_thread_count=1, pii_classification_thread_count=1)
+                                    endpoint_url=COMPREHEND_ENDPOINT_URL, pii_redaction_thread_count=thread_count, pii_classification_thread_count=thread_count)
     retries = {
         'max_attempts': COMPREHEND_MAX_RETRIES, 
         'mode': CLIENT_MODE
     }
-    config = botocore.config.Config(retries=retries, region_name=region_name)
+    config = botocore.config.Config(retries=retries, region_name=region_name, max_pool_connections=max(10, thread_count))
     comprehend = boto3.client(service_name='comprehend',config=config, region_name=region_name)
     comprehendClient.comprehend = comprehend
     print("New Comprehend client: ", retries)
     return comprehendClient
 
+
+class SharedExecutor(ThreadPoolExecutor):
+    """
+    The redact_modules client runs segments inside `with executor:`, which shuts
+    the pool down after every record. This pool ignores that so it can be reused,
+    call `close` to actually shut it down.
+    """
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def close(self):
+        super().shutdown(wait=True)
+
+
+class ComprehendRedactor:
+    """
+    Long-lived Comprehend redactor. The client, segmenters, redaction config and
+    thread pools are built once and shared by every call. `max_workers` threads
+    call Comprehend for segments, `document_workers` threads let `redact_many`
+    work on several documents at once.
+
+    Short texts are joined into one document per call, up to the shared 'aws'
+    batch size, and the redacted document is split back on the separator. If
+    it doesn't split cleanly (an entity ran across the separator) the texts are
+    redacted one by one instead.
+    """
+    def __init__(self, region_name='us-east-1', max_workers=8, document_workers=4, language_code=DEFAULT_LANGUAGE_CODE):
+        self.language_code = language_code
+        self.client = getComprehendClient(region_name=region_name, thread_count=max_workers)
+        self.segment_executor = SharedExecutor(max_workers=max_workers, thread_name_prefix='comprehend')
+        self.client.redaction_executor_service = self.segment_executor
+        self.client.classification_executor_service = self.segment_executor
+        # Documents get their own pool, segments submitted from a document thread must never wait behind documents
+        self.document_executor = ThreadPoolExecutor(max_workers=document_workers, thread_name_prefix='redact')
+        self.redaction_config = RedactionConfig()
+        self.classification_segmenter = Segmenter(DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES)
+        self.redaction_segmenter = Segmenter(DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES)
+        self.redactor = Redactor(self.redaction_config)
+        self.batch_size = get_batch_size('aws')
+        self.cache_config = {'language': language_code, 'entity_types': os.environ["PII_ENTITY_TYPES"], 'packed': True}
+
+    def redact(self, text):
+        return self.redact_many([text])[0]
+
+    def redact_many(self, texts):
+        """Returns the redacted version of each text, in order."""
+        return fetch_cached(get_cache(), 'aws', self.cache_config, texts,
+                            self._redact_packed,
+                            lambda redacted: redacted.encode('utf-8'), lambda value: value.decode('utf-8'))
+
+    def _redact_packed(self, texts):
+        chunks = [[text for _, text in chunk] for chunk in self.batch_size.pack(texts)]
+        return [redacted for chunk in self.document_executor.map(self._redact_chunk, chunks) for redacted in chunk]
+
+    def _redact_chunk(self, texts):
+        if len(texts) == 1:
+            return [self._redact_uncached(texts[0])]
+        text, _ = join_documents(texts)
+        with self.batch_size.request(len(texts), get_limiter('aws')):
+            parts = self._redact_uncached(text).split(PACK_SEPARATOR)
+        if len(parts) != len(texts):
+            return [self._redact_uncached(text) for text in texts]
+        return parts
+
+    def _redact_uncached(self, text):
+        document = get_limiter('aws').call(redact, text, self.classification_segmenter, self.redaction_segmenter,
+                            self.redactor, self.client, self.redaction_config, self.language_code)
+        return document.redacted_text
+
+    def close(self):
+        self.document_executor.shutdown(wait=True)
+        self.segment_executor.close()
+
+
 """
 Entry point - call once for each text record to be redacted. Returns redacted version of text.
 """
-comprehendClient = None 
+redactors = {}
 def redact_text(text, region_name='us-east-1'):
-    global comprehendClient
-    if not comprehendClient:
-        comprehendClient = getComprehendClient(region_name='us-east-1')
-    else:
-        # renew exector service property to allow reuse of comprehendClient
-        comprehendClient.redaction_executor_service = ThreadPoolExecutor(max_workers=1)
-    language_code = DEFAULT_LANGUAGE_CODE
-    redaction_config = RedactionConfig()
-    pii_classification_segmenter = Segmenter(DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES)
-    pii_redaction_segmenter = Segmenter(DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES)
-    redactor = Redactor(redaction_config)
-    document = redact(text, pii_classification_segmenter, pii_redaction_segmenter, redactor,
-                        comprehendClient, redaction_config, language_code)
-    return(document.redacted_text)
+    if region_name not in redactors:
+        redactors[region_name] = ComprehendRedactor(region_name=region_name)
+    return redactors[region_name].redact(text)
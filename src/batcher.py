@@ -0,0 +1,223 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+import logging
+import threading
+import time
+from metrics import get_metrics
+
+
+class BatchLimits:
+    """
+    What one request to a provider may hold: at most `max_count` documents,
+    `max_chars` characters and `max_bytes` UTF-8 bytes in total. `quota` is
+    what the provider's rate limit counts, 'requests' or 'documents'.
+    """
+
+    def __init__(self, max_count, max_chars=None, max_bytes=None, quota='requests'):
+        self.max_count = max_count
+        self.max_chars = max_chars
+        self.max_bytes = max_bytes
+        self.quota = quota
+
+
+DEFAULT_BATCH_LIMITS = {
+    # PII recognition takes 5 documents and 125,000 characters per request, quota is per document
+    'azure': BatchLimits(5, max_chars=125_000, quota='documents'),
+    # DLP caps a request at 0.5 MB, this leaves room for the table framing
+    'gcp': BatchLimits(500, max_bytes=400_000),
+    # DetectPiiEntities takes one 100 KB text, short documents are packed into it with PACK_SEPARATOR
+    'aws': BatchLimits(50, max_bytes=90_000),
+}
+
+# Goes between documents packed into one text: a Unicode PARAGRAPH SEPARATOR (U+2029) between
+# newlines. The providers don't tag it and plain text rarely contains it, so the redacted text
+# can be split back on it
+PACK_SEPARATOR = "\n\u2029\n"
+
+
+def pack_documents(documents, limits, max_count=None):
+    """
+    Yields lists of (index, document), each filled up to the limits, in
+    order. `max_count` lowers the document count limit. A document over the
+    size limits on its own gets a request of its own.
+    """
+    max_count = min(max_count or limits.max_count, limits.max_count)
+    chunk, chunk_chars, chunk_bytes = [], 0, 0
+    for i, document in enumerate(documents):
+        chars = len(document)
+        size = len(document.encode("utf-8")) if limits.max_bytes is not None else 0
+        if chunk and (len(chunk) >= max_count or
+                      (limits.max_chars is not None and chunk_chars + chars > limits.max_chars) or
+                      (limits.max_bytes is not None and chunk_bytes + size > limits.max_bytes)):
+            yield chunk
+            chunk, chunk_chars, chunk_bytes = [], 0, 0
+        chunk.append((i, document))
+        chunk_chars += chars
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
+def join_documents(documents):
+    """Joins documents with PACK_SEPARATOR. Returns the text and each document's start offset in it."""
+    offsets, start = [], 0
+    for document in documents:
+        offsets.append(start)
+        start += len(document) + len(PACK_SEPARATOR)
+    return PACK_SEPARATOR.join(documents), offsets
+
+
+class AdaptiveBatchSize:
+    """
+    The number of documents to put in each request to one provider, tuned
+    AIMD-style from the requests it has seen. Without a `target_latency`
+    every request is filled to the limits, which is what offline jobs want.
+    With one, the size grows by `increase` after each full request that was
+    faster than the target and is cut by `decrease` after a slower one, so
+    online callers get bounded latency.
+
+    A throttled request grows the size instead when the quota counts
+    requests, since the same documents then need fewer of them.
+    """
+
+    def __init__(self, provider, limits=None, target_latency=None, min_count=1, increase=1, decrease=0.5):
+        self.provider = provider
+        self.limits = limits or DEFAULT_BATCH_LIMITS[provider]
+        self.target_latency = target_latency
+        self.min_count = min(min_count, self.limits.max_count)
+        self.increase = increase
+        self.decrease = decrease
+        self.size = float(self.limits.max_count)
+        self.lock = threading.Lock()
+
+    @property
+    def count(self):
+        return max(self.min_count, int(self.size))
+
+    def pack(self, documents):
+        return pack_documents(documents, self.limits, self.count)
+
+    def observe(self, count, seconds, throttled=False):
+        get_metrics().observe("provider_batch_documents", count, provider=self.provider)
+        with self.lock:
+            if throttled and self.limits.quota == 'requests':
+                self.size = min(self.limits.max_count, self.size * 2)
+            elif self.target_latency is None:
+                return
+            elif seconds > self.target_latency:
+                self.size = max(self.min_count, self.size * self.decrease)
+            elif count >= self.count:
+                self.size = min(self.limits.max_count, self.size + self.increase)
+
+    @contextmanager
+    def request(self, count, limiter=None):
+        """Times a request of `count` documents, and whether `limiter` was throttled meanwhile, into `observe`."""
+        throttles = limiter.throttles if limiter is not None else 0
+        start = time.perf_counter()
+        yield
+        self.observe(count, time.perf_counter() - start, limiter is not None and limiter.throttles > throttles)
+
+
+_batch_sizes = {}
+_batch_sizes_lock = threading.Lock()
+
+
+def get_batch_size(provider):
+    """Returns the process-wide batch size for `provider`, shared by every service instance."""
+    with _batch_sizes_lock:
+        if provider not in _batch_sizes:
+            _batch_sizes[provider] = AdaptiveBatchSize(provider)
+        return _batch_sizes[provider]
+
+
+def configure_batch_size(provider, **kwargs):
+    """Replaces the shared batch size for `provider`, e.g. to give it a latency target."""
+    with _batch_sizes_lock:
+        _batch_sizes[provider] = AdaptiveBatchSize(provider, **kwargs)
+        return _batch_sizes[provider]
+
+
+class MicroBatcher:
+    """
+    Collects documents submitted one at a time, e.g. by request handlers, into
+    batched calls of `fn`, which takes a list of documents and returns one
+    result per document. A batch is sent as soon as it reaches
+    `batch_size.count` or the provider's size limits, or when its oldest
+    document has waited `max_delay` seconds. Up to `max_workers` batches are
+    in flight at once, and while they all are the next batch keeps filling.
+
+        batcher = MicroBatcher(lambda docs: service.recognize_spans(docs, info_types), get_batch_size('gcp'))
+        spans = batcher.submit(text).result()
+    """
+
+    def __init__(self, fn, batch_size, max_delay=0.05, max_workers=4, name="batcher"):
+        self.fn = fn
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.pending = []
+        self.condition = threading.Condition()
+        self.closed = False
+        self.slots = threading.BoundedSemaphore(max_workers)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, document):
+        """Returns a Future for the document's result."""
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("MicroBatcher is closed")
+            self.pending.append((document, future, time.monotonic()))
+            self.condition.notify()
+        return future
+
+    def map(self, documents):
+        futures = [self.submit(document) for document in documents]
+        return [future.result() for future in futures]
+
+    def close(self):
+        """Sends what is still pending and waits for every batch to finish."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+
+    def _next_batch_size(self):
+        # Only the head of the queue can go in the next request
+        count = self.batch_size.count
+        return len(next(self.batch_size.pack([document for document, _, _ in self.pending[:count + 1]])))
+
+    def _run(self):
+        while True:
+            self.slots.acquire()
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    self.slots.release()
+                    return
+                deadline = self.pending[0][2] + self.max_delay
+                while True:
+                    size = self._next_batch_size()
+                    full = size < len(self.pending) or size >= self.batch_size.count
+                    remaining = deadline - time.monotonic()
+                    if self.closed or full or remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch, self.pending = self.pending[:size], self.pending[size:]
+            self.executor.submit(self._send, batch)
+
+    def _send(self, batch):
+        try:
+            results = self.fn([document for document, _, _ in batch])
+        except Exception as e:
+            logging.error(f"Batch of {len(batch)} documents failed: {str(e)}")
+            for _, future, _ in batch:
+                future.set_exception(e)
+        else:
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+        finally:
+            self.slots.release()
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = "cache/pii_results.sqlite"
+DEFAULT_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+
+class ResultCache:
+    """
+    Persistent provider result cache in SQLite, keyed by a hash of
+    (provider, config, text). Once the stored values pass `max_bytes` the least
+    recently used entries are evicted.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Sharded runs share one cache file between processes, so wait on their write locks
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    @staticmethod
+    def key(provider, config, text):
+        payload = json.dumps([provider, config, text], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, value):
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time())
+            )
+            self.total_bytes += len(value) - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Evict down to 90% so we don't run an eviction on every put once full
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute("SELECT key, size FROM results ORDER BY accessed").fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        self.conn.executemany("DELETE FROM results WHERE key = ?", evicted)
+
+    def fetch_many(self, provider, config, documents, fetch, encode, decode, should_store=lambda result: True):
+        """
+        Returns one result per document, calling `fetch` only for the documents
+        not already cached. `fetch` takes a list of documents and returns a list
+        of results in the same order.
+        """
+        keys, results, missing = self.lookup_many(provider, config, documents, decode)
+        if missing:
+            fetched = fetch([documents[i] for i in missing])
+            self.store_many(keys, results, missing, fetched, encode, should_store)
+        return results
+
+    async def afetch_many(self, provider, config, documents, fetch, encode, decode, should_store=lambda result: True):
+        """`fetch_many` where `fetch` is a coroutine function."""
+        keys, results, missing = self.lookup_many(provider, config, documents, decode)
+        if missing:
+            fetched = await fetch([documents[i] for i in missing])
+            self.store_many(keys, results, missing, fetched, encode, should_store)
+        return results
+
+    def lookup_many(self, provider, config, documents, decode):
+        """Returns the keys, the results with None where missing, and the indexes of the missing documents."""
+        keys = [self.key(provider, config, document) for document in documents]
+        results = [None] * len(documents)
+        missing = []
+        for i, key in enumerate(keys):
+            value = self.get(key)
+            if value is None:
+                missing.append(i)
+            else:
+                results[i] = decode(value)
+        return keys, results, missing
+
+    def store_many(self, keys, results, missing, fetched, encode, should_store):
+        for i, result in zip(missing, fetched):
+            results[i] = result
+            if should_store(result):
+                self.put(keys[i], encode(result))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "bytes": self.total_bytes,
+        }
+
+
+_cache = None
+_cache_configured = False
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns the process-wide result cache, or None if caching was disabled. The
+    location comes from PII_CACHE_PATH, set it to an empty string to disable.
+    """
+    global _cache, _cache_configured
+    with _cache_lock:
+        if not _cache_configured:
+            path = os.getenv("PII_CACHE_PATH", DEFAULT_CACHE_PATH)
+            _cache = ResultCache(path) if path else None
+            _cache_configured = True
+        return _cache
+
+
+def configure_cache(path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+    """Replaces the shared cache. Passing `path=None` disables caching."""
+    global _cache, _cache_configured
+    with _cache_lock:
+        _cache = ResultCache(path, max_bytes) if path else None
+        _cache_configured = True
+        return _cache
+
+
+def fetch_cached(cache, provider, config, documents, fetch, encode, decode, should_store=lambda result: True):
+    if cache is None:
+        return fetch(documents)
+    return cache.fetch_many(provider, config, documents, fetch, encode, decode, should_store)
+
+
+async def afetch_cached(cache, provider, config, documents, fetch, encode, decode, should_store=lambda result: True):
+    if cache is None:
+        return await fetch(documents)
+    return await cache.afetch_many(provider, config, documents, fetch, encode, decode, should_store)
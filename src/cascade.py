@@ -0,0 +1,100 @@
+from collections import Counter
+import logging
+import re
+from local_detector import LocalPIIDetector, PERSON, ADDRESS
+
+NO_PII = "no_pii"
+REGEX = "regex"
+CLOUD = "cloud"
+
+# Capitalized words that don't hint at a name, place or organization
+COMMON_CAPITALIZED = set("""
+i i'm i'll i've i'd hi hello hey dear thanks thank regards best cheers sincerely yes no ok okay please
+sorry sure great good morning afternoon evening the a an this that these those it we you they he she
+our your my is are was can could would should will do does did have has what when where why how which
+monday tuesday wednesday thursday friday saturday sunday customer agent support user assistant
+re fw fwd subject ticket issue
+""".split())
+
+WORD_RE = re.compile(r"[A-Za-z][A-Za-z'-]*")
+LONG_NUMBER_RE = re.compile(r"\d{4,}")
+
+
+def starts_sentence(text, index):
+    i = index - 1
+    while i >= 0 and text[i] in " \t\"'(*-":
+        i -= 1
+    return i < 0 or text[i] in ".!?:\n"
+
+
+class CascadeRouter:
+    """
+    Cheap first stage in front of the cloud services. Each document is sent to
+    one of three routes:
+
+    - no_pii: the local detector found nothing and nothing looks like a name
+    - regex: everything found is structured (email, phone, ids, dates) and the
+      local detector's spans are trusted as-is
+    - cloud: there are capitalized words or gazetteer hits that need real NER
+
+    Only `cloud` documents should be forwarded to the paid APIs.
+    """
+
+    def __init__(self, detector=None, max_unexplained_capitalized=0):
+        self.detector = detector or LocalPIIDetector()
+        self.max_unexplained_capitalized = max_unexplained_capitalized
+        self.counts = Counter()
+        self.chars = Counter()
+
+    def unexplained_capitalized(self, text, spans):
+        """Capitalized words outside any span that aren't just starting a sentence."""
+        covered = [(span["start"], span["end"]) for span in spans]
+        count = 0
+        for match in WORD_RE.finditer(text):
+            word = match.group(0)
+            if not word[0].isupper() or word.lower() in COMMON_CAPITALIZED:
+                continue
+            if starts_sentence(text, match.start()) and not word.isupper():
+                continue
+            if any(start <= match.start() < end for start, end in covered):
+                continue
+            count += 1
+        return count
+
+    def route(self, text):
+        """Returns (route, local spans) for one document."""
+        spans = self.detector.detect(text)
+        if any(span["label"] in (PERSON, ADDRESS) for span in spans):
+            decision = CLOUD
+        elif self.unexplained_capitalized(text, spans) > self.max_unexplained_capitalized:
+            decision = CLOUD
+        elif any(not any(span["start"] <= m.start() < span["end"] for span in spans)
+                 for m in LONG_NUMBER_RE.finditer(text)):
+            # Long digit runs the regexes couldn't place may be account numbers or odd dates
+            decision = CLOUD
+        elif spans:
+            decision = REGEX
+        else:
+            decision = NO_PII
+        self.counts[decision] += 1
+        self.chars[decision] += len(text)
+        return decision, spans
+
+    def route_many(self, texts):
+        return [self.route(text) for text in texts]
+
+    def summary(self):
+        total = sum(self.counts.values())
+        skipped = total - self.counts[CLOUD]
+        return {
+            "documents": total,
+            "routes": dict(self.counts),
+            "skipped_documents": skipped,
+            "skipped_fraction": skipped / total if total else 0.0,
+            "skipped_chars": sum(self.chars.values()) - self.chars[CLOUD],
+        }
+
+    def log_summary(self):
+        summary = self.summary()
+        logging.info(f"Cascade routing: {summary}")
+        return summary
@@ -1,28 +1,24 @@
-from datasets import load_dataset
+from datasets import load_dataset_builder
+from ingest import load_filtered, SOURCE_DATASET
+import sys
 
-# Load the dataset
-ds = load_dataset("gretelai/synthetic_pii_finance_multilingual")
+# Stream the filtered subset (or reuse the locally cached copy),
+# optionally from local Parquet files given on the command line
+filtered_ds = load_filtered(sys.argv[1:] or None)
 
-# Define the filter conditions
-document_types = ["Email", "IT support ticket", "Customer support conversational log"]
+# PII types of interest
 pii_types = ["company", "email", "date", "street_address", "name"]
-language = "English"
-
-# Apply the filters
-filtered_ds = ds.filter(
-    lambda example: (
-        example['document_type'] in document_types and
-        example['language'] == language
-    )
-)
 
 # Print some information about the filtered dataset
-print(f"Original dataset size: {len(ds['train'])}")
-print(f"Filtered dataset size: {len(filtered_ds['train'])}")
+# Only the dataset card metadata is fetched for this, not the data
+splits = load_dataset_builder(SOURCE_DATASET).info.splits
+if splits:
+    print(f"Original dataset size: {splits['train'].num_examples}")
+print(f"Filtered dataset size: {len(filtered_ds)}")
 
 # Display a few examples from the filtered dataset
 print("\nSample entries from the filtered dataset:")
-for i, example in enumerate(filtered_ds['train'].select(range(5))):
+for i, example in enumerate(filtered_ds.select(range(5))):
     print(f"\nExample {i + 1}:")
     print(f"Document Type: {example['document_type']}")
     print(f"Language: {example['language']}")
@@ -0,0 +1,117 @@
+import glob
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from metrics import get_metrics
+
+# Arrow type of a span column, one list of span records (see spans.make_span) per row
+SPAN_STRUCT = pa.struct([
+    pa.field("provider", pa.string()),
+    pa.field("start", pa.int32()),
+    pa.field("end", pa.int32()),
+    pa.field("label", pa.string()),
+    pa.field("score", pa.float32()),
+    pa.field("text", pa.string()),
+])
+SPAN_LIST = pa.list_(SPAN_STRUCT)
+
+RESULT_FIELDS = [
+    pa.field("row_id", pa.int64()),
+    pa.field("azure_spans", SPAN_LIST),
+    pa.field("gcp_spans", SPAN_LIST),
+    pa.field("ensemble_spans", SPAN_LIST),
+    pa.field("route", pa.string()),
+    pa.field("local_spans", SPAN_LIST),
+    pa.field("processing_status", pa.string()),
+    pa.field("error_message", pa.string()),
+]
+
+
+class ShardWriter:
+    """
+    Buffers processed rows and writes them to `output_dir` as numbered Parquet
+    shards, so a crashed run can pick up from the last shard written. A row
+    appearing in several shards (an error that was retried) resolves to the
+    newest copy when merging.
+    """
+
+    def __init__(self, output_dir, schema, rows_per_shard=1000):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.schema = schema
+        self.rows_per_shard = rows_per_shard
+        self.buffer = {name: [] for name in schema.names}
+        self.buffered = 0
+        self.next_shard = len(self.shard_paths())
+
+    def shard_paths(self):
+        return sorted(glob.glob(os.path.join(self.output_dir, "shard-*.parquet")))
+
+    def completed_ids(self):
+        """Row ids that finished successfully in a previous run."""
+        completed = set()
+        for path in self.shard_paths():
+            table = pq.read_table(path, columns=["row_id", "processing_status"])
+            done = table.filter(pc.equal(table["processing_status"], "success"))
+            completed.update(done["row_id"].to_pylist())
+        return completed
+
+    def write(self, batch):
+        for name in self.schema.names:
+            self.buffer[name].extend(batch[name])
+        self.buffered += len(batch["row_id"])
+        if self.buffered >= self.rows_per_shard:
+            self.flush()
+
+    def flush(self):
+        if not self.buffered:
+            return
+        path = os.path.join(self.output_dir, f"shard-{self.next_shard:05d}.parquet")
+        with get_metrics().stage("serialize"):
+            table = pa.Table.from_pydict(self.buffer, schema=self.schema)
+            # Write then rename so a crash mid-write never leaves a partial shard behind
+            pq.write_table(table, path + ".tmp")
+            os.replace(path + ".tmp", path)
+        get_metrics().observe("shard_bytes", os.path.getsize(path))
+        self.next_shard += 1
+        self.buffer = {name: [] for name in self.schema.names}
+        self.buffered = 0
+
+    def merge(self):
+        """Combines every shard into `merged.parquet`, keeping the newest copy of each row."""
+        self.flush()
+        return merge_shards(self.shard_paths(), self.schema, os.path.join(self.output_dir, "merged.parquet"))
+
+
+def merge_shards(paths, schema, output_path):
+    """
+    Writes the rows of every shard in `paths` to `output_path` sorted by
+    row_id. Where a row appears more than once the copy in the later shard wins.
+    """
+    table = pa.concat_tables(pq.read_table(path, schema=schema) for path in paths)
+    latest = {}
+    for i, row_id in enumerate(table["row_id"].to_pylist()):
+        latest[row_id] = i
+    merged = table.take([latest[row_id] for row_id in sorted(latest)])
+    pq.write_table(merged, output_path)
+    return output_path
+
+
+def worker_dir(output_dir, index, count):
+    """Where worker `index` of `count` writes its shards."""
+    return os.path.join(output_dir, f"worker-{index:03d}-of-{count:03d}")
+
+
+def merge_workers(output_dir, count, schema):
+    """
+    Merges the shards of all `count` workers under `output_dir` into
+    `merged.parquet`. Fails if a worker's directory is missing.
+    """
+    paths = []
+    for index in range(count):
+        directory = worker_dir(output_dir, index, count)
+        if not os.path.isdir(directory):
+            raise FileNotFoundError(f"No output from worker {index}/{count} in {directory}")
+        paths.extend(sorted(glob.glob(os.path.join(directory, "shard-*.parquet"))))
+    return merge_shards(paths, schema, os.path.join(output_dir, "merged.parquet"))
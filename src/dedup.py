@@ -0,0 +1,289 @@
+from batcher import PACK_SEPARATOR
+from metrics import get_metrics
+from segmenter import merge_segment_spans
+import bisect
+import difflib
+import re
+import zlib
+import numpy as np
+
+PARAGRAPH_BREAK = re.compile(r"\n[ \t]*\n")
+WORD = re.compile(r"\w+")
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def split_paragraphs(text):
+    """The (offset, paragraph) pieces of `text` between blank lines, without the whitespace-only ones."""
+    paragraphs = []
+    start = 0
+    for match in PARAGRAPH_BREAK.finditer(text):
+        if text[start:match.start()].strip():
+            paragraphs.append((start, text[start:match.start()]))
+        start = match.end()
+    if text[start:].strip():
+        paragraphs.append((start, text[start:]))
+    return paragraphs
+
+
+class MinHasher:
+    """MinHash signatures over lower-cased word `shingle`-grams, `num_perm` values each."""
+
+    def __init__(self, num_perm=64, shingle=3, seed=0):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self.shingle = shingle
+
+    def signature(self, text):
+        words = WORD.findall(text.lower())
+        grams = {" ".join(words[i:i + self.shingle]) for i in range(max(1, len(words) - self.shingle + 1))}
+        hashes = np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint64, count=len(grams))
+        return ((self.a[:, None] * hashes[None, :] + self.b[:, None]) % MERSENNE_PRIME).min(axis=1)
+
+
+class LSHIndex:
+    """Banded locality-sensitive hashing over MinHash signatures, to find candidate near-duplicates."""
+
+    def __init__(self, bands=16):
+        self.bands = bands
+        self.buckets = [{} for _ in range(bands)]
+
+    def _keys(self, signature):
+        return [band.tobytes() for band in np.array_split(signature, self.bands)]
+
+    def add(self, key, signature):
+        for buckets, band in zip(self.buckets, self._keys(signature)):
+            buckets.setdefault(band, []).append(key)
+
+    def query(self, signature):
+        candidates = []
+        seen = set()
+        for buckets, band in zip(self.buckets, self._keys(signature)):
+            for key in buckets.get(band, ()):
+                if key not in seen:
+                    seen.add(key)
+                    candidates.append(key)
+        return candidates
+
+
+def cut_spans(spans, start, end, text):
+    """The spans starting in [start, end) of a packed unit, cut at `end` and with offsets into `text`, the part they came from."""
+    cut = []
+    for span in spans:
+        if start <= span["start"] < end:
+            span_start, span_end = span["start"] - start, min(span["end"], end) - start
+            cut.append(dict(span, start=span_start, end=span_end, text=text[span_start:span_end]))
+    return cut
+
+
+def snap_window(text, start, end):
+    # Widen to whole words so an entity next to the change is sent whole
+    while start > 0 and not text[start - 1].isspace():
+        start -= 1
+    while end < len(text) and not text[end].isspace():
+        end += 1
+    return start, end
+
+
+class Paragraph:
+    """A unique paragraph whose spans, once known, are reused for every copy of it."""
+
+    def __init__(self, text):
+        self.text = text
+        self.spans = {}
+        self.alive = True
+
+
+class DedupPlan:
+    """
+    What to send for one batch of texts. `units` holds one text per input
+    text that has new content: its unseen paragraphs, and the changed parts of
+    near-duplicate ones with some context, joined by PACK_SEPARATOR.
+    """
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.units = []
+        # Per text, (offset, kind, paragraph, windows) for each of its paragraphs. kind is 'send',
+        # 'copy' or 'diff', windows the (start, end, unit, unit start) parts of it that were sent
+        self.pieces = [[] for _ in texts]
+        self.opcodes = {}
+        self.new_paragraphs = []
+
+
+class Deduplicator:
+    """
+    Sends each paragraph to the providers only once across a run. Paragraphs
+    (text between blank lines) already seen are copied from their first
+    occurrence. Near-duplicates, found with MinHash/LSH and at least
+    `threshold` similar by difflib, are sent only as windows of `context`
+    characters around the parts that changed, and spans in the unchanged
+    parts are carried over. Findings are mapped back onto every occurrence
+    with offsets into its own text.
+
+    `plan` picks what to send for a batch, `restore` maps one provider's
+    results back onto the texts and `finish` keeps the paragraphs every
+    provider answered for, so later batches can reuse them. Remembered
+    paragraphs are dropped once there are more than `max_paragraphs`.
+    """
+
+    def __init__(self, providers, threshold=0.8, context=40, num_perm=64, bands=16,
+                 max_near_chars=2000, max_paragraphs=200_000):
+        self.providers = tuple(providers)
+        self.threshold = threshold
+        self.context = context
+        self.max_near_chars = max_near_chars
+        self.max_paragraphs = max_paragraphs
+        self.hasher = MinHasher(num_perm)
+        self.bands = bands
+        self.chars_input = 0
+        self.chars_sent = 0
+        self.reset()
+
+    def reset(self):
+        self.exact = {}
+        self.index = LSHIndex(self.bands)
+        self.paragraphs = []
+
+    def plan(self, texts):
+        if len(self.paragraphs) > self.max_paragraphs:
+            self.reset()
+        plan = DedupPlan(texts)
+        for row, text in enumerate(texts):
+            unit = len(plan.units)
+            fragments, position = [], 0
+            for offset, paragraph_text in split_paragraphs(text):
+                kind, paragraph, opcodes, windows = self._match(paragraph_text)
+                if kind == "send":
+                    paragraph = Paragraph(paragraph_text)
+                    self._remember(paragraph)
+                    plan.new_paragraphs.append(paragraph)
+                elif kind == "diff":
+                    plan.opcodes[row, offset] = opcodes
+                located = []
+                for start, end in windows:
+                    located.append((start, end, unit, position))
+                    fragments.append(paragraph_text[start:end])
+                    position += end - start + len(PACK_SEPARATOR)
+                plan.pieces[row].append((offset, kind, paragraph, located))
+            if fragments:
+                plan.units.append(PACK_SEPARATOR.join(fragments))
+
+        chars_input, chars_sent = sum(len(text) for text in texts), sum(len(unit) for unit in plan.units)
+        self.chars_input += chars_input
+        self.chars_sent += chars_sent
+        metrics = get_metrics()
+        metrics.increment("dedup_chars_total", chars_input, kind="input")
+        metrics.increment("dedup_chars_total", chars_sent, kind="sent")
+        return plan
+
+    def restore(self, plan, provider, unit_results):
+        """
+        Args:
+            plan: The batch's plan.
+            provider: The provider `unit_results` came from.
+            unit_results: One list of span records (or an exception) per unit.
+        Returns:
+            A list of span records, or the exception, per text in the plan.
+        """
+        # Spans for the new paragraphs first, other texts of the batch may copy them
+        for pieces in plan.pieces:
+            for _, kind, paragraph, windows in pieces:
+                if kind == "send":
+                    (start, end, unit, unit_start), = windows
+                    result = unit_results[unit]
+                    paragraph.spans[provider] = result if isinstance(result, Exception) else \
+                        cut_spans(result, unit_start, unit_start + end - start, paragraph.text)
+
+        results = []
+        for row, (text, pieces) in enumerate(zip(plan.texts, plan.pieces)):
+            try:
+                results.append(self._restore_text(plan, row, text, pieces, provider, unit_results))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def finish(self, plan):
+        """Forgets this batch's new paragraphs that some provider failed on, so they are sent again."""
+        for paragraph in plan.new_paragraphs:
+            if any(isinstance(paragraph.spans.get(provider), Exception) or provider not in paragraph.spans
+                   for provider in self.providers):
+                paragraph.alive = False
+                if self.exact.get(paragraph.text) is paragraph:
+                    del self.exact[paragraph.text]
+
+    def summary(self):
+        if not self.chars_input:
+            return "nothing sent"
+        return f"sent {self.chars_sent} of {self.chars_input} characters ({self.chars_sent / self.chars_input:.1%})"
+
+    def _match(self, text):
+        """Returns (kind, matched paragraph, opcodes, windows to send)."""
+        paragraph = self.exact.get(text)
+        if paragraph is not None:
+            return "copy", paragraph, None, []
+        if len(text) <= self.max_near_chars:
+            signature = self.hasher.signature(text)
+            for candidate in self.index.query(signature):
+                paragraph = self.paragraphs[candidate]
+                if not paragraph.alive or min(len(text), len(paragraph.text)) < self.threshold * max(len(text), len(paragraph.text)):
+                    continue
+                matcher = difflib.SequenceMatcher(None, paragraph.text, text, autojunk=False)
+                if matcher.ratio() < self.threshold:
+                    continue
+                opcodes = matcher.get_opcodes()
+                windows = self._windows(text, opcodes)
+                # Only worth it if most of the paragraph stays unsent
+                if sum(end - start for start, end in windows) < len(text) / 2:
+                    return "diff", paragraph, opcodes, windows
+        return "send", None, None, [(0, len(text))]
+
+    def _remember(self, paragraph):
+        self.exact[paragraph.text] = paragraph
+        if len(paragraph.text) <= self.max_near_chars:
+            self.index.add(len(self.paragraphs), self.hasher.signature(paragraph.text))
+        self.paragraphs.append(paragraph)
+
+    def _windows(self, text, opcodes):
+        windows = []
+        for tag, _, _, j1, j2 in opcodes:
+            if tag == "equal":
+                continue
+            start, end = snap_window(text, max(0, j1 - self.context), min(len(text), j2 + self.context))
+            if windows and start <= windows[-1][1]:
+                windows[-1] = (windows[-1][0], max(end, windows[-1][1]))
+            else:
+                windows.append((start, end))
+        return windows
+
+    def _restore_text(self, plan, row, text, pieces, provider, unit_results):
+        segment_spans = []
+        for offset, kind, paragraph, windows in pieces:
+            spans = paragraph.spans.get(provider)
+            if isinstance(spans, Exception):
+                raise spans
+            if spans is None:
+                raise RuntimeError(f"No {provider} result for a repeated paragraph")
+            if kind == "diff":
+                segment_spans.append((offset, self._carry_over(spans, plan.opcodes[row, offset])))
+                for start, end, unit, unit_start in windows:
+                    result = unit_results[unit]
+                    if isinstance(result, Exception):
+                        raise result
+                    segment_spans.append((offset + start, cut_spans(result, unit_start, unit_start + end - start,
+                                                                    text[offset + start:offset + end])))
+            else:
+                segment_spans.append((offset, spans))
+        return merge_segment_spans(segment_spans, text)
+
+    def _carry_over(self, spans, opcodes):
+        """Moves spans that lie wholly in an unchanged block of the paragraph to the near-duplicate's offsets."""
+        equal = [(i1, i2, j1) for tag, i1, i2, j1, _ in opcodes if tag == "equal"]
+        starts = [i1 for i1, _, _ in equal]
+        carried = []
+        for span in spans:
+            k = bisect.bisect_right(starts, span["start"]) - 1
+            if k >= 0 and span["end"] <= equal[k][1]:
+                shift = equal[k][2] - equal[k][0]
+                carried.append(dict(span, start=span["start"] + shift, end=span["end"] + shift))
+        return carried
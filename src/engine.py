@@ -0,0 +1,57 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+
+
+class FanOutEngine:
+    """
+    Runs the provider calls for a batch of rows at the same time. Each provider
+    gets its own thread pool, so its pool size is the cap on in-flight requests
+    to that provider and a slow provider never starves the others.
+    """
+
+    def __init__(self, concurrency):
+        self.executors = {
+            provider: ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=provider)
+            for provider, max_workers in concurrency.items()
+        }
+        self.rows_done = 0
+        self.start_time = time.monotonic()
+
+    def run(self, texts, calls):
+        """
+        Args:
+            texts: The documents in this batch.
+            calls: A dict of provider name to (fn, chunk_size). `fn` takes a list
+                of at most `chunk_size` texts and returns one result per text.
+        Returns:
+            A dict of provider name to a list with one result per text. If a
+            call raised, every text in that chunk gets the exception instead.
+        """
+        futures = []
+        for provider, (fn, chunk_size) in calls.items():
+            for start in range(0, len(texts), chunk_size):
+                chunk = texts[start:start + chunk_size]
+                future = self.executors[provider].submit(fn, chunk)
+                futures.append((provider, start, len(chunk), future))
+
+        results = {provider: [None] * len(texts) for provider in calls}
+        for provider, start, size, future in futures:
+            try:
+                chunk_results = future.result()
+            except Exception as e:
+                logging.error(f"{provider} call failed for {size} rows: {str(e)}")
+                chunk_results = [e] * size
+            results[provider][start:start + size] = chunk_results
+
+        self.rows_done += len(texts)
+        logging.info(f"Processed {self.rows_done} rows ({self.rows_per_second():.2f} rows/s)")
+        return results
+
+    def rows_per_second(self):
+        elapsed = time.monotonic() - self.start_time
+        return self.rows_done / elapsed if elapsed > 0 else 0.0
+
+    def shutdown(self):
+        for executor in self.executors.values():
+            executor.shutdown(wait=True)
@@ -0,0 +1,158 @@
+from collections import defaultdict
+import json
+from spans import make_span
+from taxonomy import SCORED_TYPES, canonical_type, request_labels
+
+MERGE_STRATEGIES = ("union", "vote", "score")
+
+# Counts from the study run in the README, used for the default routing until
+# per-type scores from `eval.py --batched --save-scores` are passed in
+README_COUNTS = {
+    'true': {'email': 1130, 'name': 4124, 'street_address': 1458, 'phone_number': 385, 'date': 5390},
+    'azure': {'email': 721, 'name': 4443, 'street_address': 878, 'phone_number': 389, 'date': 4109},
+    'gcp': {'email': 1110, 'name': 5215, 'street_address': 1013, 'phone_number': 0, 'date': 4529},
+}
+README_PRECISION = {'azure': 0.8165, 'gcp': 0.8635}
+
+
+def readme_scores():
+    """
+    Coarse per-type scores from the README run: recall is detected / true
+    (capped at 1), precision is the provider's overall precision.
+    """
+    return {
+        provider: {
+            pii_type: {'precision': precision, 'recall': min(1.0, README_COUNTS[provider][pii_type] / true)}
+            for pii_type, true in README_COUNTS['true'].items()
+        }
+        for provider, precision in README_PRECISION.items()
+    }
+
+
+def load_scores(path):
+    """Per-type scores as written by `eval.py --save-scores`: {provider: {type: {precision, recall}}}."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def f1_score(scores):
+    precision, recall = scores['precision'], scores['recall']
+    return 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+
+
+def plan_routes(type_scores, pii_types=SCORED_TYPES, margin=0.0, min_f1=0.0):
+    """
+    Picks the providers for each type: the one with the best F1 on it, plus any
+    within `margin` of the best. A type no provider scores above `min_f1` on
+    gets no provider.
+
+    Returns:
+        A dict of type -> sorted list of providers.
+    """
+    routes = {}
+    for pii_type in pii_types:
+        f1s = {provider: f1_score(scores[pii_type]) for provider, scores in type_scores.items() if pii_type in scores}
+        best = max(f1s.values(), default=0.0)
+        routes[pii_type] = sorted(provider for provider, f1 in f1s.items()
+                                  if f1 > min_f1 and f1 >= best - margin)
+    return routes
+
+
+class Ensemble:
+    """
+    Runs each entity type only on the providers that handle it best, and
+    merges their spans into one list per document. Overlapping spans of the
+    same type are one entity, which is kept:
+
+    - union: always
+    - vote: if at least `min_votes` of the providers routed for its type found it
+    - score: if the noisy-or of each provider's score, weighted by that
+      provider's precision on the type, reaches `min_score`
+
+    Merged spans have provider 'ensemble' and a canonical type as their label.
+    """
+
+    def __init__(self, routes, strategy="union", type_scores=None, min_votes=2, min_score=0.5):
+        if strategy not in MERGE_STRATEGIES:
+            raise ValueError(f"Invalid merge strategy '{strategy}'. Choose one of {MERGE_STRATEGIES}")
+        self.routes = routes
+        self.strategy = strategy
+        self.type_scores = type_scores or {}
+        self.min_votes = min_votes
+        self.min_score = min_score
+        self.provider_types = defaultdict(set)
+        for pii_type, providers in routes.items():
+            for provider in providers:
+                self.provider_types[provider].add(pii_type)
+
+    @classmethod
+    def from_scores(cls, type_scores=None, strategy="union", margin=0.0, min_f1=0.0, **kwargs):
+        type_scores = type_scores or readme_scores()
+        return cls(plan_routes(type_scores, margin=margin, min_f1=min_f1), strategy, type_scores, **kwargs)
+
+    def types_for(self, provider):
+        return sorted(self.provider_types.get(provider, ()))
+
+    def labels_for(self, provider):
+        """The provider's own labels to request (e.g. DLP info types) for the types routed to it."""
+        return request_labels(provider, self.types_for(provider))
+
+    def merge(self, provider_spans):
+        """
+        Args:
+            provider_spans: A dict of provider name -> span records for one
+                document. None or an exception for a provider is skipped.
+        Returns:
+            The merged span records, sorted by start.
+        """
+        by_type = defaultdict(list)
+        for provider, spans in provider_spans.items():
+            if spans is None or isinstance(spans, Exception):
+                continue
+            for span in spans:
+                pii_type = canonical_type(provider, span['label'])
+                # Types not routed to this provider are ignored even if it found them
+                if pii_type is not None and provider in self.routes.get(pii_type, ()):
+                    by_type[pii_type].append((provider, span))
+
+        merged = []
+        for pii_type, members in by_type.items():
+            for cluster in self._clusters(members):
+                span = self._resolve(pii_type, cluster)
+                if span is not None:
+                    merged.append(span)
+        return sorted(merged, key=lambda span: (span['start'], span['end']))
+
+    def _clusters(self, members):
+        # Overlapping spans, transitively, form one cluster
+        clusters = []
+        end = None
+        for provider, span in sorted(members, key=lambda member: member[1]['start']):
+            if clusters and span['start'] < end:
+                clusters[-1].append((provider, span))
+                end = max(end, span['end'])
+            else:
+                clusters.append([(provider, span)])
+                end = span['end']
+        return clusters
+
+    def _resolve(self, pii_type, cluster):
+        _, best = max(cluster, key=lambda member: (member[1]['score'] or 0.0, member[1]['end'] - member[1]['start']))
+        score = best['score'] or 0.0
+        if self.strategy == "vote":
+            voters = {provider for provider, _ in cluster}
+            if len(voters) < min(self.min_votes, len(self.routes[pii_type])):
+                return None
+        elif self.strategy == "score":
+            # Each provider's best score on the cluster, weighted by its precision on the type
+            weighted = {}
+            for provider, span in cluster:
+                precision = self.type_scores.get(provider, {}).get(pii_type, {}).get('precision', 1.0)
+                weighted[provider] = max(weighted.get(provider, 0.0), (span['score'] or 0.0) * precision)
+            missed = 1.0
+            for value in weighted.values():
+                missed *= 1.0 - value
+            score = 1.0 - missed
+            if score < self.min_score:
+                return None
+        return make_span("ensemble", best['start'], best['end'], pii_type, score, best['text'])
@@ -1,44 +1,34 @@
 from datasets import load_dataset
 import re
 from collections import defaultdict
+import argparse
 import json
+import numpy as np
+from span_metrics import span_counts, MATCH_MODES
+from taxonomy import SCORED_TYPES, NUM_SCORED, TYPE_IDS, type_ids
 
-# Define the PII types we're interested in
-PII_TYPES = {'name', 'email', 'date', 'phone_number', 'street_address'}
-
-# Mapping dictionaries
-azure_mapping = {
-    'Person': 'name',
-    'PersonType': 'name',
-    'Organization': 'name',
-    'Address': 'street_address',
-    'Email': 'email',
-    'DateTime': 'date',
-    'Date': 'date',
-    'PhoneNumber': 'phone_number',
-}
-
-gcp_mapping = {
-    'PERSON_NAME': 'name',
-    'ORGANIZATION_NAME': 'name',
-    'STREET_ADDRESS': 'street_address',
-    'EMAIL_ADDRESS': 'email',
-    'DATE': 'date',
-    'PHONE_NUMBER': 'phone_number',
-}
-
-def map_entity_type(entity_type, mapping):
-    return mapping.get(entity_type, entity_type.lower())
-
-def extract_entity_types(result_string, mapping):
+# The PII types we're interested in, the scored part of the taxonomy. Their
+# taxonomy ids are the column order for the per-type arrays in the batched evaluation
+PII_TYPES = set(SCORED_TYPES)
+TYPE_ORDER = SCORED_TYPES
+TYPE_INDEX = {pii_type: TYPE_IDS[pii_type] for pii_type in TYPE_ORDER}
+NAME_ID = TYPE_IDS['name']
+
+def scored_ids(provider, labels):
+    """Taxonomy ids of the labels that map to a scored type, in order."""
+    return [type_id for type_id in type_ids(provider, labels) if 0 <= type_id < NUM_SCORED]
+
+# Results pushed before the span columns existed only have the str() blobs of the SDK responses
+def extract_entity_ids(result_string, provider='azure'):
     pattern = r"category=(.*?),"
-    entities = re.findall(pattern, result_string)
-    return [map_entity_type(entity, mapping) for entity in entities if map_entity_type(entity, mapping) in PII_TYPES]
+    return scored_ids(provider, re.findall(pattern, result_string))
 
-def extract_gcp_entity_types(result_string, mapping):
+def extract_gcp_entity_ids(result_string, provider='gcp'):
     pattern = r"name: \"(.*?)\""
-    entities = re.findall(pattern, result_string)
-    return [map_entity_type(entity, mapping) for entity in entities if map_entity_type(entity, mapping) in PII_TYPES]
+    return scored_ids(provider, re.findall(pattern, result_string))
+
+def extract_span_ids(spans, provider):
+    return scored_ids(provider, [span['label'] for span in spans or []])
 
 def calculate_metrics(true_entities, predicted_entities):
     true_set = set(true_entities)
@@ -53,23 +43,29 @@ def calculate_metrics(true_entities, predicted_entities):
     
     return precision, recall, f1
 
-def count_names(entities):
+def count_names(entities, name='name'):
+    # Consecutive name entities are one name. Works on type names or, with name=NAME_ID, type ids
     name_count = 0
     for i, entity in enumerate(entities):
-        if entity == 'name':
-            if i == 0 or entities[i-1] != 'name':
+        if entity == name:
+            if i == 0 or entities[i-1] != name:
                 name_count += 1
     return name_count
 
+def provider_rows(split):
+    """The rows sent to the providers, without those a --cascade run settled locally."""
+    if 'processing_status' not in split.column_names:
+        return split
+    return split.filter(lambda status: status != 'local', input_columns='processing_status')
+
 def evaluate_services(dataset):
     azure_metrics = defaultdict(list)
     gcp_metrics = defaultdict(list)
     pii_counts = defaultdict(lambda: defaultdict(int))
     
-    for i, sample in enumerate(dataset['train']):
-        true_entities = [entity['label'] for entity in json.loads(sample['pii_spans']) if entity['label'] in PII_TYPES]
-        azure_entities = extract_entity_types(sample['azure_results'], azure_mapping)
-        gcp_entities = extract_gcp_entity_types(sample['gcp_results'], gcp_mapping)
+    for i, sample in enumerate(provider_rows(dataset['train'])):
+        entities = sample_entities(sample)
+        true_entities, azure_entities, gcp_entities = entities['true'], entities['azure'], entities['gcp']
         
         # Count names
         pii_counts['true']['name'] += count_names(true_entities)
@@ -109,6 +105,198 @@ def evaluate_services(dataset):
     
     return azure_metrics, gcp_metrics, pii_counts
 
+def sample_type_ids(sample):
+    """Scored type ids of the true and predicted entities of one row, in document order."""
+    true_ids = scored_ids('gretel', [entity['label'] for entity in json.loads(sample['pii_spans'])])
+    if 'azure_spans' in sample:
+        azure_ids = extract_span_ids(sample['azure_spans'], 'azure')
+        gcp_ids = extract_span_ids(sample['gcp_spans'], 'gcp')
+    else:
+        azure_ids = extract_entity_ids(sample['azure_results'])
+        gcp_ids = extract_gcp_entity_ids(sample['gcp_results'])
+    return {'true': true_ids, 'azure': azure_ids, 'gcp': gcp_ids}
+
+def sample_entities(sample):
+    return {source: [TYPE_ORDER[i] for i in ids] for source, ids in sample_type_ids(sample).items()}
+
+def entity_arrays_batch(batch):
+    """
+    Turns a batch of rows into fixed-width per-type rows: whether each type is
+    present in the document, and how many times it was found (names counted as runs).
+    """
+    out = defaultdict(list)
+    for values in zip(*batch.values()):
+        for source, ids in sample_type_ids(dict(zip(batch.keys(), values))).items():
+            present = [False] * NUM_SCORED
+            counts = [0] * NUM_SCORED
+            for type_id in ids:
+                present[type_id] = True
+                counts[type_id] += 1
+            counts[NAME_ID] = count_names(ids, NAME_ID)
+            out[f'{source}_present'].append(present)
+            out[f'{source}_counts'].append(counts)
+    return out
+
+def precision_recall_f1(tp, fp, fn):
+    precision = np.divide(tp, tp + fp, out=np.zeros(np.shape(tp)), where=(tp + fp) > 0)
+    recall = np.divide(tp, tp + fn, out=np.zeros(np.shape(tp)), where=(tp + fn) > 0)
+    f1 = np.divide(2 * precision * recall, precision + recall,
+                   out=np.zeros(np.shape(tp)), where=(precision + recall) > 0)
+    return precision, recall, f1
+
+def supported_mean(values, support):
+    """Mean of `values` over the types with support, 0 if none has any."""
+    return float(values[support].mean()) if support.any() else 0.0
+
+def score_counts(tp_docs, fp_docs, fn_docs):
+    """
+    Per-type TP/FP/FN from (documents x types) count arrays, plus micro and
+    macro averages and the per-document average used by `evaluate_services`.
+    The macro averages skip types where the score is undefined: precision
+    those with no predicted spans, recall those with no true spans, and F1
+    those with neither.
+    """
+    tp, fp, fn = tp_docs.sum(axis=0), fp_docs.sum(axis=0), fn_docs.sum(axis=0)
+    type_p, type_r, type_f1 = precision_recall_f1(tp, fp, fn)
+    micro = precision_recall_f1(tp.sum(), fp.sum(), fn.sum())
+    doc_p, doc_r, doc_f1 = precision_recall_f1(tp_docs.sum(axis=1), fp_docs.sum(axis=1), fn_docs.sum(axis=1))
+
+    return {
+        'per_type': {
+            pii_type: {'tp': int(tp[i]), 'fp': int(fp[i]), 'fn': int(fn[i]),
+                       'precision': float(type_p[i]), 'recall': float(type_r[i]), 'f1': float(type_f1[i])}
+            for i, pii_type in enumerate(TYPE_ORDER)
+        },
+        'micro': {'precision': float(micro[0]), 'recall': float(micro[1]), 'f1': float(micro[2])},
+        'macro': {'precision': supported_mean(type_p, (tp + fp) > 0), 'recall': supported_mean(type_r, (tp + fn) > 0),
+                  'f1': supported_mean(type_f1, (tp + fp + fn) > 0)},
+        'document': {'precision': float(doc_p.mean()), 'recall': float(doc_r.mean()), 'f1': float(doc_f1.mean())},
+    }
+
+def score_arrays(true_present, pred_present):
+    """Label-set scoring: a type counts once per document, whatever its positions."""
+    return score_counts(true_present & pred_present, pred_present & ~true_present, true_present & ~pred_present)
+
+def column_matrix(dataset, name):
+    """Reads a fixed-width list column straight from Arrow as a (rows x types) array."""
+    column = dataset.data.column(name).combine_chunks()
+    return column.flatten().to_numpy(zero_copy_only=False).reshape(len(column), len(TYPE_ORDER))
+
+def evaluate_services_batched(dataset, num_proc=None, batch_size=1000):
+    """
+    Columnar version of `evaluate_services`: rows are reduced to per-type arrays
+    with a batched (optionally multi-process) map, then scored with NumPy.
+    """
+    split = provider_rows(dataset['train'])
+    arrays = split.map(entity_arrays_batch, batched=True, batch_size=batch_size,
+                       num_proc=num_proc, remove_columns=split.column_names)
+
+    true_present = column_matrix(arrays, 'true_present')
+    results = {}
+    pii_counts = {}
+    for source in ('true', 'azure', 'gcp'):
+        counts = column_matrix(arrays, f'{source}_counts').sum(axis=0)
+        pii_counts[source] = {pii_type: int(counts[i]) for i, pii_type in enumerate(TYPE_ORDER)}
+        if source != 'true':
+            results[source] = score_arrays(true_present, column_matrix(arrays, f'{source}_present'))
+    return results, pii_counts
+
+def span_tuples(provider, spans):
+    """(start, end, type id) for the spans of a scored type."""
+    spans = spans or []
+    return [(span['start'], span['end'], type_id)
+            for span, type_id in zip(spans, type_ids(provider, [span['label'] for span in spans]))
+            if 0 <= type_id < NUM_SCORED]
+
+def span_counts_batch(batch, mode, iou_threshold, sources=('azure', 'gcp')):
+    out = defaultdict(list)
+    for row, pii_spans in enumerate(batch['pii_spans']):
+        true_spans = span_tuples('gretel', json.loads(pii_spans))
+        for source in sources:
+            spans = batch[f'{source}_spans'][row]
+            counts = span_counts(true_spans, span_tuples(source, spans), mode, iou_threshold)
+            for i, name in enumerate(('tp', 'fp', 'fn')):
+                out[f'{source}_{name}'].append([counts[type_id][i] if type_id in counts else 0
+                                                for type_id in range(NUM_SCORED)])
+    return out
+
+def evaluate_spans_batched(dataset, mode='exact', iou_threshold=0.5, num_proc=None, batch_size=1000):
+    """
+    Span-level scoring: provider spans must line up with the `pii_spans`
+    offsets (exactly, by any overlap, or above an IoU threshold) to count.
+    """
+    split = dataset['train']
+    if 'azure_spans' not in split.column_names:
+        raise ValueError("Span-level scoring needs the azure_spans / gcp_spans columns")
+    split = provider_rows(split)
+    # Results from an --ensemble run are scored as a third source
+    sources = ('azure', 'gcp', 'ensemble') if 'ensemble_spans' in split.column_names else ('azure', 'gcp')
+    arrays = split.map(span_counts_batch, batched=True, batch_size=batch_size, num_proc=num_proc,
+                       fn_kwargs={'mode': mode, 'iou_threshold': iou_threshold, 'sources': sources},
+                       remove_columns=split.column_names)
+
+    results = {}
+    pii_counts = {}
+    for source in sources:
+        tp, fp, fn = (column_matrix(arrays, f'{source}_{name}') for name in ('tp', 'fp', 'fn'))
+        results[source] = score_counts(tp, fp, fn)
+        pii_counts['true'] = dict(zip(TYPE_ORDER, (tp + fn).sum(axis=0).tolist()))
+        pii_counts[source] = dict(zip(TYPE_ORDER, (tp + fp).sum(axis=0).tolist()))
+    return results, pii_counts
+
+def evaluate_store(store, mode='exact', iou_threshold=0.5):
+    """
+    `evaluate_spans_batched` on a result store (see result_store.py), without
+    loading the results dataset. Rows a source has no results for are skipped
+    rather than counted as misses.
+    """
+    results = {}
+    pii_counts = {'true': dict.fromkeys(TYPE_ORDER, 0)}
+    for source in ('azure', 'gcp', 'ensemble'):
+        if source not in store.sources():
+            continue
+        tp, fp, fn = store.span_count_arrays(source, mode, iou_threshold)
+        results[source] = score_counts(tp, fp, fn)
+        pii_counts[source] = dict(zip(TYPE_ORDER, (tp + fp).sum(axis=0).tolist()))
+        # Documents differ per source, so the true count is for the widest one
+        true_counts = (tp + fn).sum(axis=0).tolist()
+        if sum(true_counts) > sum(pii_counts['true'].values()):
+            pii_counts['true'] = dict(zip(TYPE_ORDER, true_counts))
+    return results, pii_counts
+
+def save_scores(results, path):
+    """Writes the per-type precision/recall of each source, as read by `ensemble.load_scores`."""
+    scores = {
+        source: {pii_type: {'precision': scores['precision'], 'recall': scores['recall']}
+                 for pii_type, scores in source_results['per_type'].items()}
+        for source, source_results in results.items() if source != 'ensemble'
+    }
+    with open(path, 'w') as f:
+        json.dump(scores, f, indent=2)
+    print(f"\nPer-type scores written to {path}")
+
+def print_batched_results(results, pii_counts):
+    for source, name in (('azure', 'Azure'), ('gcp', 'GCP'), ('ensemble', 'Ensemble')):
+        if source not in results:
+            continue
+        print(f"\n{name} Results:")
+        for average in ('document', 'micro', 'macro'):
+            scores = results[source][average]
+            print(f"  {average.capitalize():<9} Precision: {scores['precision']:.4f}  "
+                  f"Recall: {scores['recall']:.4f}  F1 Score: {scores['f1']:.4f}")
+        for pii_type, scores in results[source]['per_type'].items():
+            print(f"  {pii_type:<15} TP: {scores['tp']:<6} FP: {scores['fp']:<6} FN: {scores['fn']:<6} "
+                  f"P: {scores['precision']:.4f}  R: {scores['recall']:.4f}  F1: {scores['f1']:.4f}")
+
+    print("\nPII Type Counts:")
+    for pii_type in TYPE_ORDER:
+        print(f"\n{pii_type.capitalize()}:")
+        print(f"  True labels: {pii_counts['true'][pii_type]}")
+        print(f"  Azure detected: {pii_counts['azure'][pii_type]}")
+        print(f"  GCP detected: {pii_counts['gcp'][pii_type]}")
+        if 'ensemble' in pii_counts:
+            print(f"  Ensemble detected: {pii_counts['ensemble'][pii_type]}")
+
 def print_results(azure_metrics, gcp_metrics, pii_counts):
     print("\nAzure Results:")
     print(f"Precision: {sum(azure_metrics['precision']) / len(azure_metrics['precision']):.4f}")
@@ -127,7 +315,44 @@ def print_results(azure_metrics, gcp_metrics, pii_counts):
         print(f"  Azure detected: {pii_counts['azure'][pii_type]}")
         print(f"  GCP detected: {pii_counts['gcp'][pii_type]}")
 
-# Main execution
-dataset = load_dataset("cdreetz/filtered-pii-results")
-azure_metrics, gcp_metrics, pii_counts = evaluate_services(dataset)
-print_results(azure_metrics, gcp_metrics, pii_counts)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score the provider results against the Gretel labels")
+    parser.add_argument("--dataset", default="cdreetz/filtered-pii-results")
+    parser.add_argument("--batched", action="store_true",
+                        help="Score the whole dataset in columnar batches, with micro/macro averages")
+    parser.add_argument("--num-proc", type=int, default=None,
+                        help="Processes used for the batched map")
+    parser.add_argument("--span-mode", choices=MATCH_MODES, default=None,
+                        help="Score spans by offset instead of label sets per document")
+    parser.add_argument("--iou-threshold", type=float, default=0.5,
+                        help="Minimum overlap for --span-mode iou")
+    parser.add_argument("--store", default=None,
+                        help="Score spans from a result store built with result_store.py instead of loading the dataset")
+    parser.add_argument("--save-scores", default=None,
+                        help="Write per-type precision/recall to this JSON file, for main.py --ensemble-scores")
+    args = parser.parse_args()
+    if args.save_scores and not (args.batched or args.span_mode or args.store):
+        parser.error("--save-scores needs --batched, --span-mode or --store")
+
+    if args.store:
+        from result_store import ResultStore
+        results, pii_counts = evaluate_store(ResultStore(args.store), args.span_mode or 'exact', args.iou_threshold)
+        print_batched_results(results, pii_counts)
+        if args.save_scores:
+            save_scores(results, args.save_scores)
+        raise SystemExit
+
+    dataset = load_dataset(args.dataset)
+    if args.span_mode:
+        results, pii_counts = evaluate_spans_batched(dataset, args.span_mode, args.iou_threshold, num_proc=args.num_proc)
+        print_batched_results(results, pii_counts)
+        if args.save_scores:
+            save_scores(results, args.save_scores)
+    elif args.batched:
+        results, pii_counts = evaluate_services_batched(dataset, num_proc=args.num_proc)
+        print_batched_results(results, pii_counts)
+        if args.save_scores:
+            save_scores(results, args.save_scores)
+    else:
+        azure_metrics, gcp_metrics, pii_counts = evaluate_services(dataset)
+        print_results(azure_metrics, gcp_metrics, pii_counts)
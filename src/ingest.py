@@ -0,0 +1,98 @@
+from datasets import Dataset, load_dataset
+import glob
+import hashlib
+import json
+import logging
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as pads
+from metrics import get_metrics
+
+SOURCE_DATASET = "gretelai/synthetic_pii_finance_multilingual"
+DOCUMENT_TYPES = ["Email", "IT support ticket", "Customer support conversational log"]
+LANGUAGE = "English"
+SUBSET_CACHE_DIR = "cache"
+
+
+def iter_parquet(paths, document_types=DOCUMENT_TYPES, language=LANGUAGE, batch_size=1000):
+    """
+    Yields filtered record batches from local Parquet files. The filter is
+    pushed down to the Parquet reader, so row groups whose statistics rule them
+    out are skipped and only matching rows are decoded.
+    """
+    files = sorted(path for pattern in paths for path in glob.glob(pattern))
+    if not files:
+        raise ValueError(f"No Parquet files match {paths}")
+    dataset = pads.dataset(files, format="parquet")
+    predicate = pc.field("document_type").isin(document_types) & (pc.field("language") == language)
+    for batch in dataset.to_batches(filter=predicate, batch_size=batch_size):
+        if batch.num_rows:
+            yield batch
+
+
+def iter_streaming(source=SOURCE_DATASET, document_types=DOCUMENT_TYPES, language=LANGUAGE, split="train", batch_size=1000):
+    """
+    Yields filtered record batches while streaming `source` from the hub, so
+    nothing but the current batch is held in memory.
+    """
+    stream = load_dataset(source, split=split, streaming=True)
+    stream = stream.filter(lambda example: example["document_type"] in document_types and example["language"] == language)
+    schema = stream.features.arrow_schema if stream.features is not None else None
+    rows = []
+    for example in stream:
+        rows.append(example)
+        if len(rows) >= batch_size:
+            batch = pa.RecordBatch.from_pylist(rows, schema=schema)
+            schema = batch.schema
+            yield batch
+            rows = []
+    if rows:
+        yield pa.RecordBatch.from_pylist(rows, schema=schema)
+
+
+def iter_filtered(parquet_paths=None, **kwargs):
+    """Filtered record batches from local Parquet if given, otherwise streamed from the hub."""
+    if parquet_paths:
+        return iter_parquet(parquet_paths, **kwargs)
+    return iter_streaming(**kwargs)
+
+
+def subset_cache_path(parquet_paths=None, **kwargs):
+    # One cached file per source and filter combination
+    key = json.dumps([parquet_paths, sorted(kwargs.items())], sort_keys=True, default=str)
+    return os.path.join(SUBSET_CACHE_DIR, f"filtered_{hashlib.sha256(key.encode()).hexdigest()[:16]}.arrow")
+
+
+def load_filtered(parquet_paths=None, subset_path=None, refresh=False, **kwargs):
+    """
+    Returns the filtered subset as a memory-mapped Dataset. The first call
+    streams the filtered rows into an Arrow file at `subset_path`, later calls
+    just open that file.
+    """
+    subset_path = subset_path or subset_cache_path(parquet_paths, **kwargs)
+    metrics = get_metrics()
+    if refresh or not os.path.exists(subset_path):
+        if os.path.dirname(subset_path):
+            os.makedirs(os.path.dirname(subset_path), exist_ok=True)
+        rows = 0
+        writer = None
+        # Unique per process, in case several workers on a shared filesystem build it at once
+        tmp_path = f"{subset_path}.{os.getpid()}.tmp"
+        with metrics.stage("filter"), open(tmp_path, "wb") as sink:
+            for batch in iter_filtered(parquet_paths, **kwargs):
+                if writer is None:
+                    schema = batch.schema
+                    writer = pa.ipc.new_stream(sink, schema)
+                if batch.schema != schema:
+                    batch = pa.Table.from_batches([batch]).cast(schema)
+                writer.write(batch)
+                rows += batch.num_rows
+            if writer is None:
+                raise ValueError("No rows matched the document type and language filters")
+            writer.close()
+        os.replace(tmp_path, subset_path)
+        metrics.increment("filtered_rows_total", rows)
+        logging.info(f"Cached {rows} filtered rows to {subset_path}")
+    with metrics.stage("load"):
+        return Dataset.from_file(subset_path)
@@ -0,0 +1,260 @@
+from collections import deque
+import re
+from spans import make_span
+
+# Labels follow the DLP info type names so the same info_types lists and
+# mappings work for the local and GCP services
+EMAIL = "EMAIL_ADDRESS"
+PHONE = "PHONE_NUMBER"
+SSN = "US_SOCIAL_SECURITY_NUMBER"
+ITIN = "US_INDIVIDUAL_TAXPAYER_IDENTIFICATION_NUMBER"
+CREDIT_CARD = "CREDIT_CARD_NUMBER"
+DATE = "DATE"
+PERSON = "PERSON_NAME"
+ADDRESS = "STREET_ADDRESS"
+
+LOCAL_INFO_TYPES = [EMAIL, PHONE, SSN, ITIN, CREDIT_CARD, DATE, PERSON, ADDRESS]
+
+FIRST_NAMES = """
+aaron adam adrian alan albert alex alexander alice alicia amanda amber amy andrea andrew angela anna anne
+anthony antonio ashley barbara benjamin beth betty brandon brenda brian brittany bruce carl carlos carol
+caroline catherine charles charlotte cheryl chris christina christine christopher cynthia daniel danielle
+david deborah debra dennis diana diane donald donna dorothy douglas dylan edward elizabeth emily emma eric
+evelyn frank gary george gloria grace gregory hannah harold heather helen henry isabella jack jacob
+james jane janet jason jean jeffrey jennifer jeremy jerry jessica joan john jonathan jose joseph joshua
+joyce juan judith julia julie justin karen katherine kathleen kathryn kayla keith kelly kenneth kevin
+kimberly kyle larry laura lauren linda lisa logan lori louis madison margaret maria marie marilyn mark
+martha mary matthew megan melissa michael michelle nancy nathan nicholas nicole noah olivia pamela
+patricia patrick paul peter philip rachel ralph raymond rebecca richard robert roger ronald rose russell
+ryan samantha samuel sandra sara sarah scott sean sharon shirley sophia stephanie stephen steven susan
+teresa terry thomas timothy tyler victoria vincent virginia walter wayne william zachary
+""".split()
+
+LAST_NAMES = """
+adams allen anderson baker brown campbell carter clark collins cook davis diaz edwards evans flores
+garcia gomez gonzalez green hall harris hernandez hill jackson james johnson jones king lee lewis lopez
+martin martinez miller mitchell moore morgan morris murphy nelson nguyen parker perez phillips ramirez
+reed rivera roberts robinson rodriguez rogers sanchez scott smith stewart taylor thomas thompson torres
+turner walker white williams wilson wright young
+""".split()
+
+STREET_SUFFIXES = """
+street st avenue ave road rd boulevard blvd lane ln drive dr court ct way place pl terrace ter parkway
+pkwy circle cir highway hwy square sq trail trl
+""".split()
+# Only these take a trailing period, so a sentence's full stop after "Elm Street" stays out of the span
+ABBREVIATED_SUFFIXES = set("st ave rd blvd ln dr ct pl ter pkwy cir hwy sq trl".split())
+
+TITLES = {"mr", "mrs", "ms", "miss", "dr", "prof"}
+
+MONTHS = (r"(?:Jan(?:uary)?|Feb(?:ruary)?|Mar(?:ch)?|Apr(?:il)?|May|June?|July?|Aug(?:ust)?|"
+          r"Sep(?:t(?:ember)?)?|Oct(?:ober)?|Nov(?:ember)?|Dec(?:ember)?)")
+
+EMAIL_RE = re.compile(r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b")
+PHONE_RE = re.compile(r"(?<![\w+])(?:\+?1[\s.-]?)?(?:\(\d{3}\)\s?|\d{3}[\s.-]?)\d{3}[\s.-]?\d{4}(?!\w)"
+                      r"|(?<!\w)\+\d{1,3}(?:[\s.-]?\d{2,4}){2,4}(?!\w)")
+SSN_RE = re.compile(r"(?<!\d)(\d{3})[- ]?(\d{2})[- ]?(\d{4})(?!\d)")
+CARD_RE = re.compile(r"(?<!\d)(?:\d[ -]?){12,18}\d(?!\d)")
+NUMERIC_DATE_RE = re.compile(r"(?<!\d)(\d{1,2})([/.-])(\d{1,2})\2(\d{4}|\d{2})(?!\d)")
+ISO_DATE_RE = re.compile(r"(?<!\d)(\d{4})-(\d{2})-(\d{2})(?!\d)")
+TEXT_DATE_RE = re.compile(
+    rf"\b{MONTHS}\.?\s+\d{{1,2}}(?:st|nd|rd|th)?,?\s+\d{{4}}\b"
+    rf"|\b\d{{1,2}}(?:st|nd|rd|th)?\s+(?:of\s+)?{MONTHS}\.?,?\s+\d{{4}}\b"
+    rf"|\b{MONTHS}\s+\d{{4}}\b"
+)
+# House number and up to four capitalized words ending right before a street suffix
+ADDRESS_PREFIX_RE = re.compile(r"\b\d{1,6}[A-Za-z]?\s+(?:[A-Z][\w'.-]*\s+){1,4}$")
+CAPITALIZED_RE = re.compile(r"\s+([A-Z][a-z'-]+)")
+
+
+class AhoCorasick:
+    """Multi-pattern matcher, finds every occurrence of any keyword in one pass over the text."""
+
+    def __init__(self, keywords):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for keyword in keywords:
+            state = 0
+            for char in keyword:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].append(keyword)
+
+        # Breadth-first pass to fill in the failure links
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def find_all(self, text):
+        """Yields (start, end, keyword) for every match."""
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for keyword in self.output[state]:
+                yield i - len(keyword) + 1, i + 1, keyword
+
+
+def lower_same_length(text):
+    # A few characters (e.g. 'İ') lower-case to two, which would shift every offset after them
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return lowered
+    return "".join(char.lower() if len(char.lower()) == 1 else char for char in text)
+
+
+def is_word_boundary(text, start, end):
+    return (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum())
+
+
+def valid_ssn(area, group, serial):
+    return area not in ("000", "666") and not area.startswith("9") and group != "00" and serial != "0000"
+
+
+def valid_itin(area, group, serial):
+    # ITINs are 9XX-XX-XXXX with the middle group in 50-65, 70-88, 90-92 or 94-99
+    group = int(group)
+    return area.startswith("9") and (50 <= group <= 65 or 70 <= group <= 88 or 90 <= group <= 92 or 94 <= group <= 99)
+
+
+def luhn_valid(digits):
+    total = 0
+    for i, digit in enumerate(reversed(digits)):
+        value = int(digit)
+        if i % 2 == 1:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+    return total % 10 == 0
+
+
+def valid_numeric_date(first, second, year):
+    first, second = int(first), int(second)
+    month_day = 1 <= first <= 12 and 1 <= second <= 31
+    day_month = 1 <= second <= 12 and 1 <= first <= 31
+    return (month_day or day_month) and len(year) in (2, 4)
+
+
+class LocalPIIDetector:
+    """
+    In-process PII detector: compiled regexes with checksum / format validation
+    for structured types, and Aho-Corasick gazetteer matching for names and
+    street addresses. Spans use the same record as the cloud services.
+    """
+
+    def __init__(self):
+        self.names = AhoCorasick(FIRST_NAMES + sorted(TITLES))
+        self.last_names = set(LAST_NAMES)
+        self.streets = AhoCorasick(STREET_SUFFIXES)
+
+    def detect(self, text, info_types=None):
+        candidates = []
+        candidates.extend(self._emails(text))
+        candidates.extend(self._ids(text))
+        candidates.extend(self._phones(text))
+        candidates.extend(self._dates(text))
+        candidates.extend(self._names(text))
+        candidates.extend(self._addresses(text))
+        if info_types is not None:
+            wanted = set(info_types)
+            candidates = [span for span in candidates if span["label"] in wanted]
+        return self._resolve_overlaps(candidates)
+
+    def _span(self, text, start, end, label, score):
+        return make_span("local", start, end, label, score, text[start:end])
+
+    def _emails(self, text):
+        return [self._span(text, m.start(), m.end(), EMAIL, 0.95) for m in EMAIL_RE.finditer(text)]
+
+    def _ids(self, text):
+        spans = []
+        for m in SSN_RE.finditer(text):
+            area, group, serial = m.groups()
+            if valid_itin(area, group, serial):
+                spans.append(self._span(text, m.start(), m.end(), ITIN, 0.9))
+            elif valid_ssn(area, group, serial) and m.group(0).count("-") + m.group(0).count(" ") in (0, 2):
+                # Bare 9-digit runs are too often other numbers, score them lower
+                score = 0.9 if not m.group(0).isdigit() else 0.5
+                spans.append(self._span(text, m.start(), m.end(), SSN, score))
+        for m in CARD_RE.finditer(text):
+            digits = re.sub(r"\D", "", m.group(0))
+            if 13 <= len(digits) <= 19 and luhn_valid(digits):
+                spans.append(self._span(text, m.start(), m.end(), CREDIT_CARD, 0.95))
+        return spans
+
+    def _phones(self, text):
+        spans = []
+        for m in PHONE_RE.finditer(text):
+            digits = re.sub(r"\D", "", m.group(0))
+            if m.group(0).startswith("+") or len(digits) == 10 or (len(digits) == 11 and digits[0] == "1"):
+                spans.append(self._span(text, m.start(), m.end(), PHONE, 0.85))
+        return spans
+
+    def _dates(self, text):
+        spans = []
+        for m in NUMERIC_DATE_RE.finditer(text):
+            if valid_numeric_date(m.group(1), m.group(3), m.group(4)):
+                spans.append(self._span(text, m.start(), m.end(), DATE, 0.8))
+        for m in ISO_DATE_RE.finditer(text):
+            if 1 <= int(m.group(2)) <= 12 and 1 <= int(m.group(3)) <= 31:
+                spans.append(self._span(text, m.start(), m.end(), DATE, 0.9))
+        for m in TEXT_DATE_RE.finditer(text):
+            spans.append(self._span(text, m.start(), m.end(), DATE, 0.9))
+        return spans
+
+    def _names(self, text):
+        spans = []
+        for start, end, keyword in self.names.find_all(lower_same_length(text)):
+            if not text[start].isupper() or not is_word_boundary(text, start, end):
+                continue
+            if keyword in TITLES:
+                # A title only counts when a capitalized name follows it
+                if end < len(text) and text[end] == ".":
+                    end += 1
+                following = CAPITALIZED_RE.match(text, end)
+                if not following:
+                    continue
+                start, end, score = following.start(1), following.end(1), 0.7
+            else:
+                score = 0.6
+            # Extend over a following surname
+            following = CAPITALIZED_RE.match(text, end)
+            if following:
+                score = 0.8 if following.group(1).lower() in self.last_names else max(score, 0.7)
+                end = following.end(1)
+            spans.append(self._span(text, start, end, PERSON, score))
+        return spans
+
+    def _addresses(self, text):
+        spans = []
+        for start, end, _ in self.streets.find_all(lower_same_length(text)):
+            if not text[start].isupper() or not is_word_boundary(text, start, end):
+                continue
+            prefix = ADDRESS_PREFIX_RE.search(text, max(0, start - 80), start)
+            if prefix:
+                if end < len(text) and text[end] == "." and text[start:end].lower() in ABBREVIATED_SUFFIXES:
+                    end += 1
+                spans.append(self._span(text, prefix.start(), end, ADDRESS, 0.75))
+        return spans
+
+    def _resolve_overlaps(self, spans):
+        # Keep the longest, then most confident, span wherever candidates overlap
+        kept = []
+        for span in sorted(spans, key=lambda s: (s["start"] - s["end"], -s["score"])):
+            if all(span["end"] <= other["start"] or span["start"] >= other["end"] for other in kept):
+                kept.append(span)
+        return sorted(kept, key=lambda s: s["start"])
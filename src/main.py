@@ -1,6 +1,21 @@
-from datasets import load_dataset, Dataset
-from pii_services import AzurePIIService, GCPPIIService
+from datasets import Dataset
+from pii_services import AzurePIIService, GCPPIIService, AZURE_MAX_BATCH_SIZE, GCP_CHUNK_SIZE
+from engine import FanOutEngine
+from rate_limit import configure_limiter, configure_limiter_share
+from cache import configure_cache, get_cache
+from checkpoint import ShardWriter, RESULT_FIELDS, worker_dir, merge_workers
+from cascade import CascadeRouter, CLOUD
+from metrics import get_metrics
+from taxonomy import SCORED_TYPES, provider_labels
+from ensemble import Ensemble, MERGE_STRATEGIES, load_scores
+from dedup import Deduplicator
+import pyarrow as pa
+from ingest import load_filtered
+import argparse
 import os
+import subprocess
+import sys
+import time
 from dotenv import load_dotenv
 import logging
 from tqdm import tqdm
@@ -17,70 +32,317 @@ hf_username = os.getenv("HUGGINGFACE_USERNAME")
 if not hf_username:
     raise ValueError("HUGGINGFACE_USERNAME not set in environment variables")
 
-def process_row(row, azure_service, gcp_service, gcp_info_types):
+def process_batch(batch, engine, azure_service, gcp_service, gcp_info_types, router=None, ensemble=None, dedup=None):
+    texts = batch['generated_text']
+    metrics = get_metrics()
+
+    # With a cascade router only the rows that need cloud NER go to the providers
+    if router is not None:
+        with metrics.stage("route"):
+            routes = router.route_many(texts)
+    else:
+        routes = [(None, None)] * len(texts)
+    cloud_rows = [i for i, (route, _) in enumerate(routes) if route in (None, CLOUD)]
+
+    # With an ensemble each provider is only asked for the types routed to it, and skipped if there are none
+    calls = {
+        'azure': (azure_service.recognize_spans, AZURE_MAX_BATCH_SIZE),
+        'gcp': (lambda chunk: gcp_service.recognize_spans(chunk, gcp_info_types), GCP_CHUNK_SIZE),
+    }
+    if ensemble is not None:
+        azure_categories = ensemble.labels_for('azure')
+        calls['azure'] = (lambda chunk: azure_service.recognize_spans(chunk, categories=azure_categories), AZURE_MAX_BATCH_SIZE)
+        calls = {provider: call for provider, call in calls.items() if ensemble.types_for(provider)}
+
+    # With dedup only paragraphs not seen before, and the changed parts of near-duplicates, are sent
+    cloud_texts = [texts[i] for i in cloud_rows]
+    if dedup is not None:
+        with metrics.stage("dedup"):
+            plan = dedup.plan(cloud_texts)
+        cloud_texts = plan.units
+
+    with metrics.stage("providers"):
+        results = engine.run(cloud_texts, calls)
+    if dedup is not None:
+        with metrics.stage("dedup"):
+            results = {provider: dedup.restore(plan, provider, provider_results) for provider, provider_results in results.items()}
+            dedup.finish(plan)
+    provider_results = {provider: dict(zip(cloud_rows, results.get(provider, [None] * len(cloud_rows))))
+                        for provider in ('azure', 'gcp')}
+    cloud_row_set = set(cloud_rows)
+
+    batch['azure_spans'] = []
+    batch['gcp_spans'] = []
+    batch['ensemble_spans'] = []
+    batch['route'] = []
+    batch['local_spans'] = []
+    batch['processing_status'] = []
+    batch['error_message'] = []
+    for i, (route, local_spans) in enumerate(routes):
+        batch['route'].append(route)
+        batch['local_spans'].append(local_spans)
+        if i not in cloud_row_set:
+            batch['azure_spans'].append(None)
+            batch['gcp_spans'].append(None)
+            batch['ensemble_spans'].append(None)
+            # Not 'success', so eval doesn't score the providers on it and a run without --cascade fills it in
+            batch['processing_status'].append('local')
+            batch['error_message'].append(None)
+            continue
+
+        azure_spans, gcp_spans = provider_results['azure'][i], provider_results['gcp'][i]
+        error = next((result for result in (azure_spans, gcp_spans) if isinstance(result, Exception)), None)
+
+        if error is not None:
+            error_message = f"Error processing row: {str(error)}"
+            logging.error(error_message)
+            batch['azure_spans'].append(None)
+            batch['gcp_spans'].append(None)
+            batch['ensemble_spans'].append(None)
+            batch['processing_status'].append('error')
+            batch['error_message'].append(error_message)
+        else:
+            batch['azure_spans'].append(azure_spans)
+            batch['gcp_spans'].append(gcp_spans)
+            if ensemble is not None:
+                with metrics.stage("ensemble"):
+                    batch['ensemble_spans'].append(ensemble.merge({'azure': azure_spans, 'gcp': gcp_spans}))
+            else:
+                batch['ensemble_spans'].append(None)
+            batch['processing_status'].append('success')
+            batch['error_message'].append(None)
+    for status in batch['processing_status']:
+        metrics.increment("rows_total", status=status)
+    return batch
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the PII services over the filtered Gretel dataset")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="Rows handed to the providers at a time")
+    parser.add_argument("--azure-concurrency", type=int, default=8,
+                        help="Max in-flight Azure requests")
+    parser.add_argument("--gcp-concurrency", type=int, default=4,
+                        help="Max in-flight GCP requests")
+    parser.add_argument("--azure-rate", type=float, default=None,
+                        help="Azure documents per second, defaults to the S tier quota")
+    parser.add_argument("--gcp-rate", type=float, default=None,
+                        help="GCP requests per second, defaults to the DLP quota")
+    parser.add_argument("--output-dir", default="output",
+                        help="Directory for the Parquet result shards, re-running resumes from it")
+    parser.add_argument("--rows-per-shard", type=int, default=1000,
+                        help="Rows buffered in memory before a shard is written")
+    parser.add_argument("--cascade", action="store_true",
+                        help="Route rows through the local detector first and only send likely-PII rows to the cloud")
+    parser.add_argument("--source-parquet", nargs="+", default=None,
+                        help="Read local Parquet files (globs ok) instead of streaming the dataset from the hub")
+    parser.add_argument("--refresh-subset", action="store_true",
+                        help="Rebuild the cached filtered subset")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always call the providers instead of reusing cached results")
+    parser.add_argument("--metrics-json", default=None,
+                        help="Where to write the metrics summary at the end, defaults to metrics.json in the output dir")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus metrics on this port while the job runs")
+    parser.add_argument("--ensemble", choices=MERGE_STRATEGIES, default=None,
+                        help="Only ask each provider for the types it handles best and merge their spans into ensemble_spans this way")
+    parser.add_argument("--ensemble-scores", default=None,
+                        help="Per-type scores from eval.py --save-scores to route on, defaults to the README study counts")
+    parser.add_argument("--ensemble-margin", type=float, default=0.0,
+                        help="Also route a type to any provider whose F1 on it is within this margin of the best")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Send repeated paragraphs once and only the changed parts of near-duplicates, copying the findings to every occurrence")
+    parser.add_argument("--dedup-threshold", type=float, default=0.8,
+                        help="Similarity above which a paragraph counts as a near-duplicate of one already sent")
+    parser.add_argument("--dedup-context", type=int, default=40,
+                        help="Characters of context sent around each changed part of a near-duplicate")
+    parser.add_argument("--shard", type=parse_shard, default=None, metavar="I/N",
+                        help="Process only shard I of N into its own directory under --output-dir, with 1/N of each provider quota")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Run N shard worker processes on this machine, then merge their output and push")
+    parser.add_argument("--merge-shards", type=int, default=None, metavar="N",
+                        help="Merge the output of N shard workers (e.g. run on other hosts) and push, without processing")
+    return parser.parse_args()
+
+def parse_shard(value):
     try:
-        text = row['generated_text']
-        azure_result = azure_service.recognize_pii([text])
-        gcp_result = gcp_service.recognize_pii([text], gcp_info_types)
-        
-        row['azure_results'] = str(azure_result)
-        row['gcp_results'] = str(gcp_result)
-        row['processing_status'] = 'success'
-    except Exception as e:
-        error_message = f"Error processing row: {str(e)}"
-        logging.error(error_message)
-        row['azure_results'] = None
-        row['gcp_results'] = None
-        row['processing_status'] = 'error'
-        row['error_message'] = error_message
-    return row
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected a shard as i/N, got '{value}'")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard index must be in 0..{count - 1}, got {index}")
+    return index, count
 
-def main():
+def shard_rows(total, index, count):
+    """The contiguous block of row ids shard `index` of `count` owns, the same on every host."""
+    return range(total * index // count, total * (index + 1) // count)
+
+def worker_command(argv, index, count, metrics_port=None):
+    """This script's command line for one worker, without the coordinator-only options."""
+    command = [sys.executable, os.path.abspath(__file__)]
+    skip_value = False
+    for arg in argv:
+        if skip_value:
+            skip_value = False
+        elif arg in ("--workers", "--metrics-port"):
+            skip_value = True
+        elif arg.startswith(("--workers=", "--metrics-port=")) or arg == "--refresh-subset":
+            continue
+        else:
+            command.append(arg)
+    command += ["--shard", f"{index}/{count}"]
+    if metrics_port:
+        command += ["--metrics-port", str(metrics_port + 1 + index)]
+    return command
+
+def run_workers(args):
+    """Runs one worker process per shard and waits for all of them. Returns the failed shard indexes."""
+    processes = []
+    for index in range(args.workers):
+        command = worker_command(sys.argv[1:], index, args.workers, args.metrics_port)
+        logging.info(f"Starting worker {index}/{args.workers}: {' '.join(command)}")
+        processes.append(subprocess.Popen(command))
+    failed = [index for index, process in enumerate(processes) if process.wait() != 0]
+    for index in failed:
+        logging.error(f"Worker {index}/{args.workers} failed")
+    return failed
+
+def load_subset(args):
+    # Load the filtered subset, streamed and cached locally on the first run
+    print("Loading dataset...")
+    load_start = time.monotonic()
+    filtered_ds = load_filtered(args.source_parquet, refresh=args.refresh_subset)
+    print(f"Loaded in {time.monotonic() - load_start:.1f}s")
+    print(f"Filtered dataset size: {len(filtered_ds)}")
+    return filtered_ds
+
+def process_rows(args, filtered_ds, row_ids, output_dir, shares=1):
+    """
+    Runs the providers over `row_ids`, writing result shards to `output_dir`.
+    With `shares` > 1 this process only uses its share of each provider's quota.
+    """
+    # Initialize services
+    if args.no_cache:
+        configure_cache(None)
+    azure_settings = {'rate': args.azure_rate, 'burst': max(args.azure_rate, AZURE_MAX_BATCH_SIZE)} if args.azure_rate else {}
+    gcp_settings = {'rate': args.gcp_rate, 'burst': args.gcp_rate} if args.gcp_rate else {}
+    if shares > 1:
+        configure_limiter_share('azure', shares, **azure_settings)
+        configure_limiter_share('gcp', shares, **gcp_settings)
+    else:
+        if azure_settings:
+            configure_limiter('azure', **azure_settings)
+        if gcp_settings:
+            configure_limiter('gcp', **gcp_settings)
+    azure_service = AzurePIIService()
+    gcp_service = GCPPIIService()
+
+    # Ask GCP for every info type that maps to a type the evaluation scores
+    gcp_info_types = provider_labels('gcp', SCORED_TYPES)
+    ensemble = None
+    if args.ensemble:
+        scores = load_scores(args.ensemble_scores) if args.ensemble_scores else None
+        ensemble = Ensemble.from_scores(scores, args.ensemble, margin=args.ensemble_margin)
+        gcp_info_types = ensemble.labels_for('gcp')
+        print(f"Ensemble routes: {ensemble.routes}")
+
+    # Resume from any shards a previous run already wrote
+    schema = pa.schema(list(filtered_ds.features.arrow_schema) + RESULT_FIELDS)
+    writer = ShardWriter(output_dir, schema, rows_per_shard=args.rows_per_shard)
+    completed = writer.completed_ids()
+    if completed:
+        print(f"Resuming, skipping {len(completed)} rows already processed")
+
+    router = CascadeRouter() if args.cascade else None
+    dedup = None
+    if args.dedup:
+        providers = ['azure', 'gcp'] if ensemble is None else [p for p in ('azure', 'gcp') if ensemble.types_for(p)]
+        dedup = Deduplicator(providers, threshold=args.dedup_threshold, context=args.dedup_context)
+
+    # Process the rows, running both providers concurrently
+    engine = FanOutEngine({'azure': args.azure_concurrency, 'gcp': args.gcp_concurrency})
     try:
-        # Load dataset
-        print("Loading dataset...")
-        ds = load_dataset("gretelai/synthetic_pii_finance_multilingual")
-
-        # Apply filters
-        document_types = ["Email", "IT support ticket", "Customer support conversational log"]
-        language = "English"
-        
-        filtered_ds = ds['train'].filter(
-            lambda example: (
-                example['document_type'] in document_types and
-                example['language'] == language
-            )
-        )
-
-        print(f"Filtered dataset size: {len(filtered_ds)}")
-
-        # Initialize services
-        azure_service = AzurePIIService()
-        gcp_service = GCPPIIService()
-
-        # Define info types for GCP
-        gcp_info_types = ["PERSON_NAME", "EMAIL_ADDRESS", "DATE", "STREET_ADDRESS", "ORGANIZATION_NAME"]
-
-        # Process the dataset
-        processed_ds = filtered_ds.map(
-            lambda row: process_row(row, azure_service, gcp_service, gcp_info_types),
-            desc="Processing rows"
-        )
-
-        # Print summary
-        success_count = sum(1 for row in processed_ds if row['processing_status'] == 'success')
-        error_count = sum(1 for row in processed_ds if row['processing_status'] == 'error')
-        print(f"Processed {len(processed_ds)} rows. Successes: {success_count}, Errors: {error_count}")
-
-        # Push to Hugging Face Hub
-        repo_name = f"{hf_username}/filtered-pii-results"
+        for start in tqdm(range(0, len(row_ids), args.batch_size), desc="Processing rows"):
+            pending = [row_id for row_id in row_ids[start:start + args.batch_size] if row_id not in completed]
+            if not pending:
+                continue
+            batch = filtered_ds[pending]
+            batch['row_id'] = pending
+            writer.write(process_batch(batch, engine, azure_service, gcp_service, gcp_info_types, router, ensemble, dedup))
+    finally:
+        writer.flush()
+        engine.shutdown()
+    print(f"Throughput: {engine.rows_per_second():.2f} rows/s")
+    if router is not None:
+        print(f"Cascade routing: {router.log_summary()}")
+    if dedup is not None:
+        print(f"Dedup: {dedup.summary()}")
+    cache = get_cache()
+    if cache is not None:
+        print(f"Result cache: {cache.stats()}")
+    return writer
+
+def publish(merged_path):
+    """Loads the merged results, prints the status counts and pushes them to the hub."""
+    processed_ds = Dataset.from_parquet(merged_path)
+
+    # Print summary
+    statuses = processed_ds['processing_status']
+    success_count = statuses.count('success')
+    error_count = statuses.count('error')
+    local_count = statuses.count('local')
+    print(f"Processed {len(processed_ds)} rows. Successes: {success_count}, Errors: {error_count}, Local only: {local_count}")
+
+    # Push to Hugging Face Hub
+    repo_name = f"{hf_username}/filtered-pii-results"
+    with get_metrics().stage("push"):
         processed_ds.push_to_hub(repo_name)
 
-        print(f"Dataset uploaded successfully to https://huggingface.co/datasets/{repo_name}")
+    print(f"Dataset uploaded successfully to https://huggingface.co/datasets/{repo_name}")
+
+def main():
+    args = parse_args()
+    metrics = get_metrics()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    output_dir = worker_dir(args.output_dir, *args.shard) if args.shard else args.output_dir
+    failed = False
+    try:
+        filtered_ds = load_subset(args)
+
+        if args.shard:
+            # One worker of a sharded run, the coordinator (or --merge-shards) merges and pushes
+            index, count = args.shard
+            process_rows(args, filtered_ds, shard_rows(len(filtered_ds), index, count), output_dir, shares=count)
+            print(f"Shard {index}/{count} done, results in {output_dir}")
+            return
+
+        if args.workers > 1 or args.merge_shards:
+            count = args.merge_shards or args.workers
+            if args.workers > 1 and run_workers(args):
+                failed = True
+                print(f"Some workers failed, re-run to resume them from {args.output_dir}")
+                return
+            schema = pa.schema(list(filtered_ds.features.arrow_schema) + RESULT_FIELDS)
+            with metrics.stage("merge"):
+                merged_path = merge_workers(args.output_dir, count, schema)
+        else:
+            writer = process_rows(args, filtered_ds, range(len(filtered_ds)), output_dir)
+            # Merge the shards, only now is the full result set materialized
+            with metrics.stage("merge"):
+                merged_path = writer.merge()
+        publish(merged_path)
 
     except Exception as e:
-        logging.error(f"An error occurred during script execution: {str(e)}")
-        print(f"An error occurred. Check the log file for details.")
+        failed = True
+        logging.exception(f"An error occurred during script execution: {str(e)}")
+        print(f"An error occurred. Check the log file for details. Re-run to resume from {output_dir}")
+    finally:
+        metrics_path = args.metrics_json or os.path.join(output_dir, "metrics.json")
+        os.makedirs(os.path.dirname(metrics_path) or ".", exist_ok=True)
+        metrics.write_json(metrics_path)
+        print(f"Metrics summary written to {metrics_path}")
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
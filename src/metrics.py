@@ -0,0 +1,185 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+import json
+import logging
+import threading
+import time
+
+# Histogram bucket upper bounds. Metrics named *_bytes use BYTE_BUCKETS, *_documents use
+# COUNT_BUCKETS, everything else is seconds
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+def buckets_for(name):
+    if name.endswith("_bytes"):
+        return BYTE_BUCKETS
+    if name.endswith("_documents"):
+        return COUNT_BUCKETS
+    return SECONDS_BUCKETS
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate from the buckets, interpolating linearly inside the bucket the quantile falls in."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else self.min
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                lower, upper = max(lower, self.min), min(upper, self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Metrics:
+    """
+    In-process counters and histograms for the pipeline, keyed by name and
+    labels (e.g. provider). Cheap enough to update from every request thread.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets_for(name))
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Records how long the block took in the `name` histogram, even if it raised."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def stage(self, stage):
+        return self.timer("stage_seconds", stage=stage)
+
+    def summary(self):
+        """Everything recorded so far as a JSON-friendly dict."""
+        with self.lock:
+            counters = [{"name": name, "labels": dict(key), "value": value}
+                        for (name, key), value in sorted(self.counters.items())]
+            histograms = [dict({"name": name, "labels": dict(key)}, **histogram.summary())
+                          for (name, key), histogram in sorted(self.histograms.items())]
+        return {
+            "started_at": self.start_time,
+            "elapsed_seconds": time.time() - self.start_time,
+            "counters": counters,
+            "histograms": histograms,
+        }
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        logging.info(f"Wrote metrics summary to {path}")
+
+    def to_prometheus(self):
+        """The Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            family = None
+            for (name, key), value in sorted(self.counters.items()):
+                if name != family:
+                    family = name
+                    lines.append(f"# TYPE pii_{name} counter")
+                lines.append(f"pii_{name}{format_labels(key)} {value}")
+            for (name, key), histogram in sorted(self.histograms.items()):
+                if name != family:
+                    family = name
+                    lines.append(f"# TYPE pii_{name} histogram")
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"pii_{name}_bucket{format_labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"pii_{name}_bucket{format_labels(key, [('le', '+Inf')])} {histogram.count}")
+                lines.append(f"pii_{name}_sum{format_labels(key)} {histogram.sum}")
+                lines.append(f"pii_{name}_count{format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="0.0.0.0"):
+        """Serves `to_prometheus` on http://host:port/metrics from a background thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        logging.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+        return server
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    """The process-wide metrics that the limiters, services and pipeline stages record into."""
+    return _metrics
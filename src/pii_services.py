@@ -1,37 +1,276 @@
-from azure.ai.textanalytics import TextAnalyticsClient
-from azure.core.credentials import AzureKeyCredential
-import google.cloud.dlp
 from dotenv import load_dotenv
-from typing import List
+from rate_limit import get_limiter
+from batcher import DEFAULT_BATCH_LIMITS, get_batch_size, join_documents
+from cache import get_cache, fetch_cached, afetch_cached
+from spans import azure_spans, gcp_spans, comprehend_spans
+from local_detector import LocalPIIDetector
+from segmenter import split_documents, merge_segment_spans
+from taxonomy import provider_labels
+from typing import List, Protocol
+import asyncio
+import bisect
+import functools
+import json
+import logging
+import multiprocessing
+import pickle
 import sys
 import os
 
 load_dotenv()
 
+# Per-request limits used when packing several documents into one call, see batcher.py
+AZURE_MAX_BATCH_SIZE = DEFAULT_BATCH_LIMITS['azure'].max_count
+# Rows per GCP table request handed to a service call, kept small enough that several are in flight per batch
+GCP_CHUNK_SIZE = 25
 
-class GCPPIIService:
-    def __init__(self):
+# Longer documents are split into overlapping segments before they are sent.
+# Azure rejects documents over 5,120 characters, DLP caps the whole request at 0.5 MB
+AZURE_MAX_DOCUMENT_CHARS = 5000
+GCP_MAX_DOCUMENT_CHARS = 100_000
+SEGMENT_OVERLAP = 200
+# Comprehend takes up to 100 KB of UTF-8 per document, this stays under it at 4 bytes a character
+COMPREHEND_MAX_DOCUMENT_CHARS = 25_000
+
+# Service name -> class. The cloud SDKs are only imported when a service is
+# constructed, so picking one provider doesn't pay for importing the others.
+PROVIDERS = {}
+PROVIDER_ENTRY_POINTS = "pii_study.providers"
+
+
+class PIIServiceError(Exception):
+    """A provider returned an error for one document rather than failing the request."""
+
+
+def register_provider(name):
+    """Class decorator that makes a service available under `name`."""
+    def decorator(cls):
+        cls.provider_name = name
+        PROVIDERS[name] = cls
+        return cls
+    return decorator
+
+
+def get_provider(name):
+    """
+    Returns the service class registered as `name`. Services living outside this
+    module can register through a `pii_study.providers` entry point instead of
+    the decorator, those are only loaded when asked for.
+    """
+    name = name.lower()
+    if name not in PROVIDERS:
+        from importlib.metadata import entry_points
+        for entry_point in entry_points(group=PROVIDER_ENTRY_POINTS):
+            if entry_point.name == name:
+                PROVIDERS[name] = entry_point.load()
+    if name not in PROVIDERS:
+        raise ValueError(f"Invalid service name '{name}'. Choose one of {sorted(PROVIDERS)}")
+    return PROVIDERS[name]
+
+
+def create_service(name, **kwargs):
+    return get_provider(name)(**kwargs)
+
+
+class PIIService(Protocol):
+    """
+    Interface shared by every provider. Positional options after `documents`
+    are provider specific (`language` for Azure, `info_types` for the others).
+    Services subclass this to get the async variants, which run the blocking
+    call on a worker thread unless a service overrides them.
+    """
+    # Whether process_documents needs an info_types list
+    requires_info_types = False
+
+    def recognize_pii(self, documents, *args, **kwargs): ...
+
+    def recognize_pii_batch(self, documents, *args, **kwargs): ...
+
+    def recognize_spans(self, documents, *args, **kwargs): ...
+
+    def process_documents(self, documents, info_types=None): ...
+
+    async def arecognize_pii(self, documents, *args, **kwargs):
+        return await asyncio.to_thread(self.recognize_pii, documents, *args, **kwargs)
+
+    async def arecognize_pii_batch(self, documents, *args, **kwargs):
+        return await asyncio.to_thread(self.recognize_pii_batch, documents, *args, **kwargs)
+
+    async def arecognize_spans(self, documents, *args, **kwargs):
+        return await asyncio.to_thread(self.recognize_spans, documents, *args, **kwargs)
+
+    # Documents per arecognize_spans call made by aiter_spans
+    async_chunk_size = 1
+
+    async def aiter_spans(self, documents, *args, **kwargs):
+        """
+        Yields (index, spans) for every document as soon as the request it was
+        in completes, so `async for i, spans in service.aiter_spans(docs)`
+        sees fast documents first. If a request failed its documents get the
+        exception instead of spans.
+        """
+        async def chunk_spans(start):
+            chunk = documents[start:start + self.async_chunk_size]
+            try:
+                return start, await self.arecognize_spans(chunk, *args, **kwargs)
+            except Exception as e:
+                logging.error(f"{self.provider_name} call failed for {len(chunk)} documents: {str(e)}")
+                return start, [e] * len(chunk)
+
+        for next_done in asyncio.as_completed([chunk_spans(start) for start in range(0, len(documents), self.async_chunk_size)]):
+            start, results = await next_done
+            for offset, result in enumerate(results):
+                yield start + offset, result
+
+    def close(self):
+        pass
+
+    async def aclose(self):
+        self.close()
+
+
+def encode_gcp_response(response):
+    from google.cloud import dlp_v2
+    return dlp_v2.InspectContentResponse.serialize(response)
+
+
+def decode_gcp_response(value):
+    from google.cloud import dlp_v2
+    return dlp_v2.InspectContentResponse.deserialize(value)
+
+
+@register_provider('gcp')
+class GCPPIIService(PIIService):
+    requires_info_types = True
+    async_chunk_size = GCP_CHUNK_SIZE
+
+    def __init__(self, limiter=None, cache=None, batch_size=None):
+        from google.cloud import dlp_v2
+        self.dlp = dlp_v2
         self.project_id = os.getenv("GCP_PROJECT_ID")
-        self.client = google.cloud.dlp_v2.DlpServiceClient()
+        endpoint = os.getenv("DLP_ENDPOINT")
+        if endpoint:
+            # A non-default endpoint (e.g. the bench/ stand-ins) is spoken to over REST without credentials
+            from google.auth.credentials import AnonymousCredentials
+            self.client = dlp_v2.DlpServiceClient(
+                    transport="rest", credentials=AnonymousCredentials(),
+                    client_options={"api_endpoint": endpoint}
+            )
+        else:
+            self.client = dlp_v2.DlpServiceClient()
         self.parent = f"projects/{self.project_id}/locations/global"
+        self.limiter = limiter or get_limiter('gcp')
+        self.cache = cache or get_cache()
+        self.batch_size = batch_size or get_batch_size('gcp')
 
     def recognize_pii(self, documents, info_types):
-        inspect_config = {
-            "info_types": [{"name": info_type} for info_type in info_types]
-        }
+        return fetch_cached(
+                self.cache, 'gcp', self._cache_config(info_types), documents,
+                lambda docs: self._inspect_documents(docs, info_types),
+                encode_gcp_response, decode_gcp_response
+        )
+
+    def recognize_pii_batch(self, documents, info_types):
+        """
+        Inspects many documents per request by packing them into the rows of a
+        single-column DLP table. Findings are split back to their document using
+        the table row index, so the returned list lines up with `documents`.
+        """
+        return fetch_cached(
+                self.cache, 'gcp', self._cache_config(info_types), documents,
+                lambda docs: self._inspect_table(docs, info_types),
+                encode_gcp_response, decode_gcp_response
+        )
+
+    def recognize_spans(self, documents, info_types):
+        """
+        Like `recognize_pii_batch`, but returns a list of span records per
+        document. Documents over GCP_MAX_DOCUMENT_CHARS are split into
+        overlapping segments and their spans mapped back onto the document.
+        """
+        segments, owners = split_documents(documents, GCP_MAX_DOCUMENT_CHARS, SEGMENT_OVERLAP)
+        return self._merge_spans(documents, segments, owners, self.recognize_pii_batch(segments, info_types))
 
+    def to_spans(self, response, document):
+        return gcp_spans(response, document)
+
+    def _merge_spans(self, documents, segments, owners, responses):
+        segment_spans = [[] for _ in documents]
+        for (i, offset), response, segment in zip(owners, responses, segments):
+            segment_spans[i].append((offset, self.to_spans(response, segment)))
+        return [merge_segment_spans(spans, document) for spans, document in zip(segment_spans, documents)]
+
+    def _cache_config(self, info_types):
+        return {"info_types": sorted(info_types)}
+
+    def _inspect_documents(self, documents, info_types):
         results = []
         for document in documents:
-            response = self.client.inspect_content(
-                    request = {
-                        "parent": self.parent,
-                        "inspect_config": inspect_config,
-                        "item": {"value": document},
-                    }
+            response = self.limiter.call(
+                    self.client.inspect_content,
+                    request=self._document_request(document, info_types),
+                    retry=None,
+                    payload_bytes=len(document.encode("utf-8"))
             )
             results.append(response)
         return results
 
+    def _inspect_table(self, documents, info_types):
+        results = [None] * len(documents)
+        for chunk in self.batch_size.pack(documents):
+            with self.batch_size.request(len(chunk), self.limiter):
+                response = self.limiter.call(
+                        self.client.inspect_content,
+                        request=self._table_request(chunk, info_types),
+                        retry=None,
+                        payload_bytes=sum(len(document.encode("utf-8")) for _, document in chunk)
+                )
+            chunk_results = self._split_table_response(chunk, response)
+            if chunk_results is None:
+                chunk_results = self._inspect_documents([document for _, document in chunk], info_types)
+            for (i, _), doc_response in zip(chunk, chunk_results):
+                results[i] = doc_response
+        return results
+
+    def _document_request(self, document, info_types):
+        return {
+            "parent": self.parent,
+            "inspect_config": {"info_types": [{"name": info_type} for info_type in info_types]},
+            "item": {"value": document},
+        }
+
+    def _table_request(self, chunk, info_types):
+        table = {
+            "headers": [{"name": "text"}],
+            "rows": [{"values": [{"string_value": document}]} for _, document in chunk],
+        }
+        return {
+            "parent": self.parent,
+            "inspect_config": {
+                "info_types": [{"name": info_type} for info_type in info_types],
+                "limits": {"max_findings_per_request": 0},
+            },
+            "item": {"table": table},
+        }
+
+    def _split_table_response(self, chunk, response):
+        """
+        Splits the findings for a table of `chunk` documents into one response
+        per document. Returns None if DLP truncated the findings.
+        """
+        if response.result.findings_truncated:
+            # Too many findings for one request, the caller falls back to one call per document
+            logging.warning(f"DLP findings truncated for a batch of {len(chunk)} documents, retrying individually")
+            return None
+        findings = [[] for _ in chunk]
+        for finding in response.result.findings:
+            row = finding.location.content_locations[0].record_location.table_location.row_index
+            findings[row].append(finding)
+        return [
+            self.dlp.InspectContentResponse(result=self.dlp.InspectResult(findings=doc_findings))
+            for doc_findings in findings
+        ]
+
     def print_pii_results(self, results):
         for i, response in enumerate(results):
             print(f"Document {i + 1}:")
@@ -52,16 +291,97 @@ class GCPPIIService:
 
 
 
-class AzurePIIService:
-    def __init__(self):
+@register_provider('azure')
+class AzurePIIService(PIIService):
+    async_chunk_size = AZURE_MAX_BATCH_SIZE
+
+    def __init__(self, limiter=None, cache=None, batch_size=None):
+        from azure.ai.textanalytics import TextAnalyticsClient
+        from azure.core.credentials import AzureKeyCredential
+        # The limiter retries, so the SDK's own retry policy is turned off
         self.client = TextAnalyticsClient(
                 endpoint=os.getenv("AZURE_ENDPOINT"), 
-                credential=AzureKeyCredential(os.getenv("AZURE_API_KEY"))
+                credential=AzureKeyCredential(os.getenv("AZURE_API_KEY")),
+                retry_total=0
+        )
+        self.limiter = limiter or get_limiter('azure')
+        self.cache = cache or get_cache()
+        self.batch_size = batch_size or get_batch_size('azure')
+
+    def recognize_pii(self, documents, language="en", categories=None):
+        results = fetch_cached(
+                self.cache, 'azure', self._cache_config(language, categories), documents,
+                lambda docs: self._recognize(docs, language, categories),
+                pickle.dumps, pickle.loads, should_store=lambda doc: not doc.is_error
+        )
+        return [doc for doc in results if not doc.is_error]
+
+    def recognize_pii_batch(self, documents, language="en", categories=None):
+        """
+        Sends up to AZURE_MAX_BATCH_SIZE documents per request, or fewer if
+        the shared batch size has a latency target to keep. Unlike
+        `recognize_pii`, errored documents are kept so the returned list lines up
+        with `documents`; check `doc.is_error` on each result. `categories`
+        limits the PII categories Azure returns.
+        """
+        return fetch_cached(
+                self.cache, 'azure', self._cache_config(language, categories), documents,
+                lambda docs: self._recognize_batch(docs, language, categories),
+                pickle.dumps, pickle.loads, should_store=lambda doc: not doc.is_error
+        )
+
+    def recognize_spans(self, documents, language="en", categories=None):
+        """
+        Like `recognize_pii_batch`, but returns a list of span records per
+        document. Documents over AZURE_MAX_DOCUMENT_CHARS are split into
+        overlapping segments and their spans mapped back onto the document.
+        A document Azure returned an error for gets a PIIServiceError instead.
+        """
+        segments, owners = split_documents(documents, AZURE_MAX_DOCUMENT_CHARS, SEGMENT_OVERLAP)
+        return self._merge_spans(documents, segments, owners, self.recognize_pii_batch(segments, language, categories))
+
+    def _merge_spans(self, documents, segments, owners, results):
+        segment_spans = [[] for _ in documents]
+        errors = {}
+        for (i, offset), doc, segment in zip(owners, results, segments):
+            if doc.is_error:
+                errors[i] = PIIServiceError(f"{doc.error.code}: {doc.error.message}")
+            else:
+                segment_spans[i].append((offset, self.to_spans(doc, segment)))
+        return [errors[i] if i in errors else merge_segment_spans(spans, document)
+                for i, (spans, document) in enumerate(zip(segment_spans, documents))]
+
+    def to_spans(self, doc, document=None):
+        return azure_spans(doc)
+
+    def _cache_config(self, language, categories=None):
+        config = {"language": language}
+        if categories is not None:
+            config["categories"] = sorted(categories)
+        return config
+
+    def _request_options(self, language, categories):
+        options = {"language": language}
+        if categories is not None:
+            options["categories_filter"] = list(categories)
+        return options
+
+    def _recognize(self, documents, language, categories=None):
+        # Azure meters quota per document, not per request
+        response = self.limiter.call(
+                self.client.recognize_pii_entities, documents, **self._request_options(language, categories),
+                cost=len(documents), payload_bytes=sum(len(document.encode("utf-8")) for document in documents)
         )
+        return list(response)
 
-    def recognize_pii(self, documents, language="en"):
-        response = self.client.recognize_pii_entities(documents, language=language)
-        return [doc for doc in response if not doc.is_error]
+    def _recognize_batch(self, documents, language, categories=None):
+        results = [None] * len(documents)
+        for chunk in self.batch_size.pack(documents):
+            with self.batch_size.request(len(chunk), self.limiter):
+                response = self._recognize([document for _, document in chunk], language, categories)
+            for (i, _), doc in zip(chunk, response):
+                results[i] = doc
+        return results
 
     def print_pii_results(self, results):
         for doc in results:
@@ -74,27 +394,355 @@ class AzurePIIService:
                 print(f"    Offset: {entity.offset}")
                 print(f"    Length: {entity.length}")
 
-    def process_documents(self, documents):
+    def process_documents(self, documents, info_types=None):
+        # Azure picks its own categories, info_types is accepted for the common interface
         results = self.recognize_pii(documents)
         self.print_pii_results(results)
 
 
-def process_documents_with_service(service_name, documents, info_types=None):
-    if service_name.lower() == 'azure':
-        service = AzurePIIService()
-        service.process_documents(documents)
-    elif service_name.lower() == 'gcp':
+@register_provider('azure-async')
+class AsyncAzurePIIService(AzurePIIService):
+    """
+    Azure on the aio client. The async methods run on the caller's event loop,
+    with up to `max_in_flight` requests at once over one shared aiohttp
+    connection pool instead of a thread per request. The blocking methods
+    still go through the sync client.
+    """
+
+    def __init__(self, max_in_flight=1000, limiter=None, cache=None, batch_size=None):
+        super().__init__(limiter, cache, batch_size)
+        self.max_in_flight = max_in_flight
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.session = None
+        self.aclient = None
+
+    def _async_client(self):
+        # Created on first use, so the connection pool belongs to the running loop
+        if self.aclient is None:
+            import aiohttp
+            from azure.ai.textanalytics.aio import TextAnalyticsClient
+            from azure.core.credentials import AzureKeyCredential
+            from azure.core.pipeline.transport import AioHttpTransport
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_in_flight))
+            self.aclient = TextAnalyticsClient(
+                    endpoint=os.getenv("AZURE_ENDPOINT"),
+                    credential=AzureKeyCredential(os.getenv("AZURE_API_KEY")),
+                    transport=AioHttpTransport(session=self.session, session_owner=False),
+                    retry_total=0
+            )
+        return self.aclient
+
+    async def arecognize_pii(self, documents, language="en", categories=None):
+        results = await self.arecognize_pii_batch(documents, language, categories)
+        return [doc for doc in results if not doc.is_error]
+
+    async def arecognize_pii_batch(self, documents, language="en", categories=None):
+        return await afetch_cached(
+                self.cache, 'azure', self._cache_config(language, categories), documents,
+                lambda docs: self._arecognize_batch(docs, language, categories),
+                pickle.dumps, pickle.loads, should_store=lambda doc: not doc.is_error
+        )
+
+    async def arecognize_spans(self, documents, language="en", categories=None):
+        segments, owners = split_documents(documents, AZURE_MAX_DOCUMENT_CHARS, SEGMENT_OVERLAP)
+        return self._merge_spans(documents, segments, owners, await self.arecognize_pii_batch(segments, language, categories))
+
+    async def _arecognize(self, documents, language, categories=None):
+        async with self.semaphore:
+            return await self.limiter.acall(
+                    self._async_client().recognize_pii_entities, documents, **self._request_options(language, categories),
+                    cost=len(documents), payload_bytes=sum(len(document.encode("utf-8")) for document in documents)
+            )
+
+    async def _arecognize_batch(self, documents, language, categories=None):
+        results = [None] * len(documents)
+
+        async def recognize_chunk(chunk):
+            with self.batch_size.request(len(chunk), self.limiter):
+                response = await self._arecognize([document for _, document in chunk], language, categories)
+            for (i, _), doc in zip(chunk, response):
+                results[i] = doc
+
+        await asyncio.gather(*(recognize_chunk(chunk) for chunk in self.batch_size.pack(documents)))
+        return results
+
+    async def aclose(self):
+        if self.aclient is not None:
+            await self.aclient.close()
+            await self.session.close()
+            self.aclient = self.session = None
+
+
+@register_provider('gcp-async')
+class AsyncGCPPIIService(GCPPIIService):
+    """
+    DLP on the gRPC asyncio client, one channel multiplexing up to
+    `max_in_flight` concurrent requests on the caller's event loop. Table
+    chunks of a batch are inspected concurrently. The async client has no REST
+    transport, so with DLP_ENDPOINT set the async methods fall back to running
+    the sync client on worker threads.
+    """
+
+    def __init__(self, max_in_flight=1000, limiter=None, cache=None, batch_size=None):
+        super().__init__(limiter, cache, batch_size)
+        self.max_in_flight = max_in_flight
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.native = not os.getenv("DLP_ENDPOINT")
+        self.aclient = None
+
+    def _async_client(self):
+        # Created on first use, so the channel belongs to the running loop
+        if self.aclient is None:
+            self.aclient = self.dlp.DlpServiceAsyncClient()
+        return self.aclient
+
+    async def arecognize_pii(self, documents, info_types):
+        if not self.native:
+            return await super().arecognize_pii(documents, info_types)
+        return await afetch_cached(
+                self.cache, 'gcp', self._cache_config(info_types), documents,
+                lambda docs: self._ainspect_documents(docs, info_types),
+                encode_gcp_response, decode_gcp_response
+        )
+
+    async def arecognize_pii_batch(self, documents, info_types):
+        if not self.native:
+            return await super().arecognize_pii_batch(documents, info_types)
+        return await afetch_cached(
+                self.cache, 'gcp', self._cache_config(info_types), documents,
+                lambda docs: self._ainspect_table(docs, info_types),
+                encode_gcp_response, decode_gcp_response
+        )
+
+    async def arecognize_spans(self, documents, info_types):
+        segments, owners = split_documents(documents, GCP_MAX_DOCUMENT_CHARS, SEGMENT_OVERLAP)
+        return self._merge_spans(documents, segments, owners, await self.arecognize_pii_batch(segments, info_types))
+
+    async def _ainspect(self, request, payload_bytes):
+        async with self.semaphore:
+            return await self.limiter.acall(
+                    self._async_client().inspect_content, request=request, retry=None, payload_bytes=payload_bytes
+            )
+
+    async def _ainspect_documents(self, documents, info_types):
+        return list(await asyncio.gather(*(
+            self._ainspect(self._document_request(document, info_types), len(document.encode("utf-8")))
+            for document in documents
+        )))
+
+    async def _ainspect_table(self, documents, info_types):
+        results = [None] * len(documents)
+
+        async def inspect_chunk(chunk):
+            with self.batch_size.request(len(chunk), self.limiter):
+                response = await self._ainspect(
+                        self._table_request(chunk, info_types),
+                        sum(len(document.encode("utf-8")) for _, document in chunk)
+                )
+            chunk_results = self._split_table_response(chunk, response)
+            if chunk_results is None:
+                chunk_results = await self._ainspect_documents([document for _, document in chunk], info_types)
+            for (i, _), doc_response in zip(chunk, chunk_results):
+                results[i] = doc_response
+
+        await asyncio.gather(*(inspect_chunk(chunk) for chunk in self.batch_size.pack(documents)))
+        return results
+
+    async def aclose(self):
+        if self.aclient is not None:
+            await self.aclient.transport.close()
+            self.aclient = None
+
+
+@register_provider('aws')
+class ComprehendPIIService(PIIService):
+    """
+    AWS Comprehend DetectPiiEntities. There is no batch form of the call, so
+    with `pack` short documents are joined into one text per request, up to
+    the shared batch size, and the entities split back by offset. Each request
+    is billed for at least 300 characters, so this saves quota as well as
+    requests on chat-sized documents. With `pack=False` every uncached
+    document gets its own request. Results are the response dicts, with
+    offsets into the document.
+    """
+
+    def __init__(self, region_name=None, language_code="en", limiter=None, cache=None, batch_size=None, pack=True):
+        import boto3
+        import botocore.config
+        self.region_name = region_name or os.getenv("AWS_REGION", "us-east-1")
+        self.language_code = language_code
+        self.client = boto3.client(
+                "comprehend", region_name=self.region_name,
+                endpoint_url=os.getenv("COMPREHEND_ENDPOINT_URL") or None,
+                config=botocore.config.Config(retries={'max_attempts': 1})
+        )
+        self.limiter = limiter or get_limiter('aws')
+        self.cache = cache or get_cache()
+        self.batch_size = batch_size or get_batch_size('aws')
+        self.pack = pack
+
+    def recognize_pii(self, documents, info_types=None):
+        results = self.recognize_pii_batch(documents)
         if info_types is None:
-            raise ValueError("Info types must be provided for GCP DLP service")
-        service = GCPPIIService()
+            return results
+        wanted = set(info_types)
+        return [{"Entities": [entity for entity in response["Entities"] if entity["Type"] in wanted]}
+                for response in results]
+
+    def recognize_pii_batch(self, documents, info_types=None):
+        config = {"operation": "detect_pii_entities", "language": self.language_code}
+        if self.pack:
+            # Neighbouring documents can sway the detections, so packed results are cached apart
+            config["packed"] = True
+        detect = self._detect_packed if self.pack else lambda docs: [self._detect(document) for document in docs]
+        return fetch_cached(
+                self.cache, 'aws', config, documents, detect,
+                lambda response: json.dumps(response).encode("utf-8"), json.loads
+        )
+
+    def recognize_spans(self, documents, info_types=None):
+        """
+        Span records per document. Documents over COMPREHEND_MAX_DOCUMENT_CHARS
+        are split into overlapping segments and their spans mapped back.
+        """
+        segments, owners = split_documents(documents, COMPREHEND_MAX_DOCUMENT_CHARS, SEGMENT_OVERLAP)
+        responses = self.recognize_pii(segments, info_types)
+        segment_spans = [[] for _ in documents]
+        for (i, offset), response, segment in zip(owners, responses, segments):
+            segment_spans[i].append((offset, self.to_spans(response, segment)))
+        return [merge_segment_spans(spans, document) for spans, document in zip(segment_spans, documents)]
+
+    def to_spans(self, response, document):
+        return comprehend_spans(response, document)
+
+    def _detect(self, document):
+        response = self.limiter.call(
+                self.client.detect_pii_entities, Text=document, LanguageCode=self.language_code,
+                payload_bytes=len(document.encode("utf-8"))
+        )
+        return {"Entities": response["Entities"]}
+
+    def _detect_packed(self, documents):
+        results = []
+        for chunk in self.batch_size.pack(documents):
+            texts = [document for _, document in chunk]
+            text, offsets = join_documents(texts)
+            with self.batch_size.request(len(chunk), self.limiter):
+                response = self._detect(text)
+            results.extend(self._split_packed(texts, offsets, response))
+        return results
+
+    def _split_packed(self, texts, offsets, response):
+        """Splits the entities found in joined `texts` into one response per text, with offsets into it."""
+        responses = [{"Entities": []} for _ in texts]
+        for entity in response["Entities"]:
+            i = bisect.bisect_right(offsets, entity["BeginOffset"]) - 1
+            begin = entity["BeginOffset"] - offsets[i]
+            end = min(entity["EndOffset"] - offsets[i], len(texts[i]))
+            # Entities starting in a separator are dropped, ones running into it are cut at the text's end
+            if begin < len(texts[i]):
+                responses[i]["Entities"].append(dict(entity, BeginOffset=begin, EndOffset=end))
+        return responses
+
+    def print_pii_results(self, results):
+        for i, response in enumerate(results):
+            print(f"Document {i + 1}:")
+            if response["Entities"]:
+                for entity in response["Entities"]:
+                    print(f"    Category: {entity['Type']}")
+                    print(f"    Confidence Score: {entity['Score']}")
+                    print(f"    Offset: {entity['BeginOffset']}")
+                    print(f"    Length: {entity['EndOffset'] - entity['BeginOffset']}")
+            else:
+                print("No findings")
+            print("---")
+
+    def process_documents(self, documents, info_types=None):
+        results = self.recognize_pii(documents, info_types)
+        self.print_pii_results(results)
+
+
+_local_detector = None
+
+
+def detect_local(document, info_types=None):
+    # Module-level so it can be shipped to pool workers, each builds its own detector once
+    global _local_detector
+    if _local_detector is None:
+        _local_detector = LocalPIIDetector()
+    return _local_detector.detect(document, info_types)
+
+
+@register_provider('local')
+class LocalPIIService(PIIService):
+    """
+    Offline detector with the same interface as the cloud services. Runs
+    in-process, and across a process pool for batches of `min_parallel`
+    documents or more. Results are already span records.
+    """
+    async_chunk_size = 64
+
+    def __init__(self, processes=None, min_parallel=256):
+        self.processes = processes or os.cpu_count() or 1
+        self.min_parallel = min_parallel
+        self.pool = None
+
+    def recognize_pii(self, documents, info_types=None):
+        if self.processes == 1 or len(documents) < self.min_parallel:
+            return [detect_local(document, info_types) for document in documents]
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes)
+        chunksize = max(1, len(documents) // (self.processes * 4))
+        return self.pool.map(functools.partial(detect_local, info_types=info_types), documents, chunksize)
+
+    def recognize_pii_batch(self, documents, info_types=None):
+        return self.recognize_pii(documents, info_types)
+
+    def recognize_spans(self, documents, info_types=None):
+        return self.recognize_pii(documents, info_types)
+
+    def to_spans(self, spans, document=None):
+        return spans
+
+    def print_pii_results(self, results):
+        for i, spans in enumerate(results):
+            print(f"Document {i + 1}:")
+            if spans:
+                for span in spans:
+                    print(f"Entity: {span['text']}")
+                    print(f"    Category: {span['label']}")
+                    print(f"    Confidence Score: {span['score']}")
+                    print(f"    Offset: {span['start']}")
+                    print(f"    Length: {span['end'] - span['start']}")
+            else:
+                print("No findings")
+            print("---")
+
+    def process_documents(self, documents, info_types=None):
+        results = self.recognize_pii(documents, info_types)
+        self.print_pii_results(results)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+def process_documents_with_service(service_name, documents, info_types=None):
+    service_class = get_provider(service_name)
+    if service_class.requires_info_types and info_types is None:
+        raise ValueError(f"Info types must be provided for the {service_name} service")
+    service = service_class()
+    try:
         service.process_documents(documents, info_types)
-    else:
-        raise ValueError("Invalid service name. Choose 'azure' or 'gcp'")
+    finally:
+        service.close()
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print("Usage: python script.py <service>")
-        print(" <service>: 'azure' or 'gcp'")
+        print(f" <service>: one of {', '.join(sorted(PROVIDERS))}")
         sys.exit(1)
 
     service = sys.argv[1].lower()
@@ -105,20 +753,14 @@ if __name__ == "__main__":
         "The employee's phone number is 555-555-5555 and their email is rob.jones@gmail.com."
     ]
 
-    info_types = [
-        "PERSON_NAME", 
-        "LOCATION", 
-        "EMAIL_ADDRESS", 
-        "US_INDIVIDUAL_TAXPAYER_IDENTIFICATION_NUMBER"
-    ]
+    info_types = provider_labels('gcp', ['name', 'location', 'email', 'itin'])
 
-    if service == 'azure':
-        process_documents_with_service('azure', documents)
-    elif service == 'gcp':
-        process_documents_with_service('gcp', documents, info_types)
-    else:
-        print(f"Error: Invalid service '{service}'. Choose 'azure' or 'gcp'.")
+    try:
+        service_class = get_provider(service)
+    except ValueError as e:
+        print(f"Error: {e}")
         sys.exit(1)
+    process_documents_with_service(service, documents, info_types if service_class.requires_info_types else None)
 
 
 # :!env/bin/python %
@@ -0,0 +1,290 @@
+from email.utils import parsedate_to_datetime
+import asyncio
+import datetime
+import logging
+import random
+import threading
+import time
+from metrics import get_metrics
+
+# Steady-state requests per second for each provider, roughly the default quotas
+DEFAULT_RATE_LIMITS = {
+    'azure': {'rate': 16.0, 'burst': 20},  # 1000 text records / minute on the S tier
+    'gcp': {'rate': 10.0, 'burst': 10},    # 600 DLP requests / minute
+    'aws': {'rate': 20.0, 'burst': 20},    # DetectPiiEntities TPS
+}
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+THROTTLING_ERROR_CODES = {'ThrottlingException', 'TooManyRequestsException', 'ProvisionedThroughputExceededException'}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class TokenBucket:
+    """Thread-safe token bucket. `acquire` blocks until enough tokens are available."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """Takes the tokens and returns 0 if there are enough, otherwise returns how long to wait."""
+        # Requests bigger than the bucket still go through once it is full
+        tokens = min(tokens, self.capacity)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        while True:
+            wait = self.reserve(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def aacquire(self, tokens=1):
+        """`acquire` for coroutines, waits without blocking the event loop."""
+        while True:
+            wait = self.reserve(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failed calls and fails fast until
+    `reset_timeout` seconds have passed, then lets a single probe call through.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError("Circuit open, provider is failing")
+            self.probing = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+def status_code(exception):
+    # Azure HttpResponseError has .status_code, google.api_core errors have an HTTP .code
+    code = getattr(exception, 'status_code', None)
+    if code is None and isinstance(getattr(exception, 'code', None), int):
+        code = exception.code
+    if code is None and isinstance(getattr(exception, 'response', None), dict):
+        code = exception.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return code
+
+
+def is_throttled(exception):
+    response = getattr(exception, 'response', None)
+    if isinstance(response, dict) and response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+        return True
+    return status_code(exception) == 429
+
+
+def is_retryable(exception):
+    if isinstance(exception, CircuitOpenError):
+        return False
+    if isinstance(exception, (ConnectionError, TimeoutError)):
+        return True
+    response = getattr(exception, 'response', None)
+    if isinstance(response, dict) and response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+        return True
+    if type(exception).__name__ in ('ServiceRequestError', 'ServiceResponseError'):
+        return True
+    return status_code(exception) in RETRYABLE_STATUS_CODES
+
+
+def retry_after(exception):
+    """Returns the server-requested delay in seconds, or None if there isn't one."""
+    response = getattr(exception, 'response', None)
+    if isinstance(response, dict):
+        headers = response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+    else:
+        headers = getattr(response, 'headers', None) or {}
+
+    for header in ('retry-after-ms', 'x-ms-retry-after-ms'):
+        value = headers.get(header)
+        if value is not None:
+            try:
+                return float(value) / 1000
+            except ValueError:
+                pass
+
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class ProviderLimiter:
+    """
+    Wraps calls to one provider with a token bucket, retries with exponential
+    backoff and full jitter (honouring Retry-After), and a circuit breaker.
+    """
+
+    def __init__(self, name, rate, burst=None, max_retries=6, base_delay=0.5, max_delay=60.0,
+                 failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst or rate)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+        self.throttles = 0
+
+    def backoff(self, attempt, exception):
+        delay = retry_after(exception)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return min(delay, self.max_delay)
+
+    def call(self, fn, *args, cost=1, payload_bytes=None, **kwargs):
+        """
+        Calls `fn`, where `cost` is the number of quota units the call uses.
+        Latency, errors and retries are recorded in the shared metrics under
+        this provider, as is `payload_bytes` if given.
+        """
+        metrics = self._record_payload(payload_bytes)
+        attempt = 0
+        while True:
+            if attempt == 0:
+                self.breaker.before_call()
+            with metrics.timer("provider_throttle_wait_seconds", provider=self.name):
+                self.bucket.acquire(cost)
+            metrics.increment("provider_requests_total", provider=self.name)
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._failed(attempt, e, time.perf_counter() - start)
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self._succeeded(cost, time.perf_counter() - start)
+            return result
+
+    async def acall(self, fn, *args, cost=1, payload_bytes=None, **kwargs):
+        """`call` for coroutine functions, sharing the same quota, breaker and metrics."""
+        metrics = self._record_payload(payload_bytes)
+        attempt = 0
+        while True:
+            if attempt == 0:
+                self.breaker.before_call()
+            with metrics.timer("provider_throttle_wait_seconds", provider=self.name):
+                await self.bucket.aacquire(cost)
+            metrics.increment("provider_requests_total", provider=self.name)
+            start = time.perf_counter()
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._failed(attempt, e, time.perf_counter() - start)
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self._succeeded(cost, time.perf_counter() - start)
+            return result
+
+    def _record_payload(self, payload_bytes):
+        metrics = get_metrics()
+        if payload_bytes is not None:
+            metrics.observe("provider_request_bytes", payload_bytes, provider=self.name)
+        return metrics
+
+    def _failed(self, attempt, exception, elapsed):
+        """Records a failed attempt and returns the delay before the retry, or raises if there is none."""
+        metrics = get_metrics()
+        metrics.observe("provider_request_seconds", elapsed, provider=self.name)
+        metrics.increment("provider_errors_total", provider=self.name, code=str(status_code(exception) or type(exception).__name__))
+        if is_throttled(exception):
+            self.throttles += 1
+        if not is_retryable(exception):
+            # Bad requests say nothing about the provider's health
+            self.breaker.record_success()
+            raise exception
+        if attempt >= self.max_retries:
+            self.breaker.record_failure()
+            raise exception
+        delay = self.backoff(attempt, exception)
+        self.retries += 1
+        metrics.increment("provider_retries_total", provider=self.name)
+        logging.warning(f"{self.name} call failed ({str(exception)}), retry {attempt + 1}/{self.max_retries} in {delay:.2f}s")
+        return delay
+
+    def _succeeded(self, cost, elapsed):
+        metrics = get_metrics()
+        metrics.observe("provider_request_seconds", elapsed, provider=self.name)
+        metrics.increment("provider_quota_units_total", cost, provider=self.name)
+        self.breaker.record_success()
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(provider):
+    """Returns the process-wide limiter for `provider`, shared by every service instance."""
+    with _limiters_lock:
+        if provider not in _limiters:
+            _limiters[provider] = ProviderLimiter(provider, **DEFAULT_RATE_LIMITS[provider])
+        return _limiters[provider]
+
+
+def configure_limiter(provider, **kwargs):
+    """Replaces the shared limiter for `provider`, e.g. to change its rate from the CLI."""
+    settings = dict(DEFAULT_RATE_LIMITS[provider], **kwargs)
+    with _limiters_lock:
+        _limiters[provider] = ProviderLimiter(provider, **settings)
+        return _limiters[provider]
+
+
+def configure_limiter_share(provider, shares, **kwargs):
+    """
+    Configures this process's even share of a provider quota split between
+    `shares` processes, e.g. the workers of a sharded run.
+    """
+    settings = dict(DEFAULT_RATE_LIMITS[provider], **kwargs)
+    settings['rate'] = settings['rate'] / shares
+    settings['burst'] = max(1, settings['burst'] / shares)
+    return configure_limiter(provider, **settings)
@@ -0,0 +1,111 @@
+import hashlib
+import numpy as np
+import pyarrow as pa
+
+POLICIES = ("mask", "type", "hash")
+
+
+def merge_spans(spans):
+    """
+    Merges overlapping (start, end, label, score) tuples, which may come from
+    several providers, into non-overlapping (start, end, label) tuples sorted by
+    start. A merged span takes the label of its highest scoring, then longest, part.
+    """
+    merged = []
+    for start, end, label, score in sorted(spans, key=lambda span: (span[0], -span[1])):
+        rank = (score or 0.0, end - start)
+        if merged and start < merged[-1][1]:
+            last = merged[-1]
+            if rank > last[3]:
+                last[2], last[3] = label, rank
+            last[1] = max(last[1], end)
+        else:
+            merged.append([start, end, label, rank])
+    return [(start, end, label) for start, end, label, _ in merged]
+
+
+def replacement(value, label, policy, mask_char="*", salt=""):
+    if policy == "mask":
+        return mask_char * len(value)
+    if policy == "type":
+        return f"[{label}]"
+    if policy == "hash":
+        # Same value, same token, so redacted logs can still be joined on it
+        digest = hashlib.sha256((salt + value).encode("utf-8")).hexdigest()[:12]
+        return f"[{label}:{digest}]"
+    raise ValueError(f"Invalid redaction policy '{policy}'. Choose one of {POLICIES}")
+
+
+def redact_tuples(text, spans, policy="type", mask_char="*", salt=""):
+    """`redact` for (start, end, label, score) tuples."""
+    pieces = []
+    position = 0
+    for start, end, label in merge_spans(spans):
+        pieces.append(text[position:start])
+        pieces.append(replacement(text[start:end], label, policy, mask_char, salt))
+        position = end
+    pieces.append(text[position:])
+    return "".join(pieces)
+
+
+def redact(text, spans, policy="type", mask_char="*", salt=""):
+    """
+    Redacts `text` using span records from any service, without calling the
+    provider again. Overlapping spans are merged first, the output is built in
+    one pass and joined once.
+
+    Args:
+        text: The original document.
+        spans: Span records (dicts with start, end, label and optionally score).
+        policy: 'mask' to overwrite each character with `mask_char`, 'type' to
+            replace with [LABEL], or 'hash' to replace with a salted token that
+            is stable for the same value.
+    """
+    return redact_tuples(
+        text, [(span["start"], span["end"], span["label"], span.get("score")) for span in spans],
+        policy, mask_char, salt
+    )
+
+
+def redact_column(texts, span_columns, policy="type", mask_char="*", salt=""):
+    """
+    Batched `redact` over Arrow columns. `span_columns` is one list<struct>
+    span column, or a list of them (e.g. Azure and GCP) whose spans are merged
+    per row. Span fields are read as flat arrays instead of per-row dicts.
+
+    Returns:
+        A pyarrow StringArray of redacted texts.
+    """
+    if not isinstance(span_columns, (list, tuple)):
+        span_columns = [span_columns]
+    if isinstance(texts, pa.ChunkedArray):
+        texts = texts.combine_chunks()
+
+    columns = []
+    for column in span_columns:
+        if isinstance(column, pa.ChunkedArray):
+            column = column.combine_chunks()
+        offsets = column.offsets.to_numpy()
+        values = column.values.slice(offsets[0], offsets[-1] - offsets[0])
+        columns.append((
+            column.is_null().to_numpy(zero_copy_only=False),
+            offsets - offsets[0],
+            values.field("start").to_numpy(zero_copy_only=False),
+            values.field("end").to_numpy(zero_copy_only=False),
+            values.field("label").to_pylist(),
+            np.nan_to_num(values.field("score").to_numpy(zero_copy_only=False)),
+        ))
+
+    redacted = []
+    for i, text in enumerate(texts.to_pylist()):
+        if text is None:
+            redacted.append(None)
+            continue
+        spans = []
+        for nulls, offsets, starts, ends, labels, scores in columns:
+            if nulls[i]:
+                continue
+            for j in range(offsets[i], offsets[i + 1]):
+                spans.append((int(starts[j]), int(ends[j]), labels[j], float(scores[j])))
+        redacted.append(redact_tuples(text, spans, policy, mask_char, salt))
+    return pa.array(redacted, type=pa.string())
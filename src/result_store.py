@@ -0,0 +1,259 @@
+"""
+Compact, memory-mapped store of the study results for analysis. Instead of
+the full results dataset (texts and result blobs included) it keeps two
+uncompressed Arrow IPC (Feather v2) files: one row per document with its
+metadata, and one row per span with int32 offsets and dictionary-encoded
+labels. Opening maps the files without reading them.
+
+    python src/result_store.py build output/merged.parquet --output store
+    python src/result_store.py query store --source gcp --type date --kind fn --document-type "IT support ticket"
+"""
+from collections import defaultdict
+import argparse
+import json
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+from span_metrics import match_spans, MATCH_MODES
+from taxonomy import CANONICAL_TYPES, NUM_SCORED, SCORED_TYPES, TYPE_IDS, type_ids
+
+DOCUMENTS_FILE = "documents.arrow"
+SPANS_FILE = "spans.arrow"
+# Span columns of the results, 'gretel' holds the true spans from pii_spans
+SPAN_SOURCES = ("azure", "gcp", "ensemble", "local")
+DOCUMENT_COLUMNS = ("document_type", "language", "processing_status", "route")
+MISTAKE_KINDS = ("fn", "fp")
+
+
+def load_results(source):
+    """The results as a Dataset, from a local Parquet file (e.g. a merged run) or a hub dataset name."""
+    from datasets import Dataset, load_dataset
+    if os.path.exists(source):
+        return Dataset.from_parquet(source)
+    return load_dataset(source, split="train")
+
+
+def dictionary_column(values, index_type=pa.int32()):
+    return pa.array(values, pa.string()).dictionary_encode().cast(pa.dictionary(index_type, pa.string()))
+
+
+def build_store(dataset, output_dir, batch_size=1000):
+    """
+    Writes the store for a results Dataset to `output_dir`, reading only the
+    columns it needs. Returns the opened store.
+    """
+    names = set(dataset.column_names)
+    sources = [source for source in SPAN_SOURCES if f"{source}_spans" in names]
+    columns = [name for name in ("row_id", "generated_text", "pii_spans") + DOCUMENT_COLUMNS if name in names]
+    columns += [f"{source}_spans" for source in sources]
+
+    documents = defaultdict(list)
+    spans = defaultdict(list)
+
+    def add_spans(row_id, source, records, text):
+        for record in records:
+            spans["row_id"].append(row_id)
+            spans["source"].append(source)
+            spans["start"].append(record["start"])
+            spans["end"].append(record["end"])
+            spans["label"].append(record["label"])
+            spans["score"].append(record.get("score"))
+            spans["text"].append(text[record["start"]:record["end"]])
+
+    row = 0
+    for batch in dataset.select_columns(columns).iter(batch_size=batch_size):
+        for i, text in enumerate(batch["generated_text"]):
+            row_id = batch["row_id"][i] if "row_id" in batch else row
+            row += 1
+            documents["row_id"].append(row_id)
+            documents["length"].append(len(text))
+            for name in DOCUMENT_COLUMNS:
+                if name in batch:
+                    documents[name].append(batch[name][i])
+            add_spans(row_id, "gretel", json.loads(batch["pii_spans"][i]), text)
+            for source in sources:
+                records = batch[f"{source}_spans"][i]
+                # Null when the provider wasn't asked or failed, so its mistakes aren't counted for the row
+                documents[f"has_{source}"].append(records is not None)
+                add_spans(row_id, source, records or [], text)
+
+    documents_table = pa.table(
+        {name: (dictionary_column(values) if name in DOCUMENT_COLUMNS else
+                pa.array(values, pa.int32() if name in ("row_id", "length") else None))
+         for name, values in documents.items()}
+    )
+    spans_table = pa.table({
+        "row_id": pa.array(spans["row_id"], pa.int32()),
+        "source": dictionary_column(spans["source"], pa.int8()),
+        "start": pa.array(spans["start"], pa.int32()),
+        "end": pa.array(spans["end"], pa.int32()),
+        "label": dictionary_column(spans["label"], pa.int16()),
+        "type_id": pa.array(label_type_ids(spans["source"], spans["label"]), pa.int8()),
+        "score": pa.array(spans["score"], pa.float32()),
+        "text": pa.array(spans["text"], pa.string()),
+    })
+
+    os.makedirs(output_dir, exist_ok=True)
+    # Uncompressed, so opening can map the buffers instead of decoding them
+    feather.write_feather(documents_table, os.path.join(output_dir, DOCUMENTS_FILE), compression="uncompressed")
+    feather.write_feather(spans_table, os.path.join(output_dir, SPANS_FILE), compression="uncompressed")
+    return ResultStore(output_dir)
+
+
+def label_type_ids(sources, labels):
+    by_source = defaultdict(list)
+    for i, source in enumerate(sources):
+        by_source[source].append(i)
+    ids = [0] * len(labels)
+    for source, indexes in by_source.items():
+        for i, type_id in zip(indexes, type_ids(source, [labels[i] for i in indexes])):
+            ids[i] = type_id
+    return ids
+
+
+class ResultStore:
+    """
+    A result store opened with memory mapping. `documents` and `spans` are
+    Arrow tables whose buffers are paged in only as queries touch them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.documents = feather.read_table(os.path.join(path, DOCUMENTS_FILE), memory_map=True)
+        self.spans = feather.read_table(os.path.join(path, SPANS_FILE), memory_map=True)
+
+    def sources(self):
+        return [name[len("has_"):] for name in self.documents.column_names if name.startswith("has_")]
+
+    def row_ids(self, document_type=None, source=None, **filters):
+        """Row ids of the documents matching the metadata filters, and that `source` has results for."""
+        mask = None
+        for name, value in dict(filters, document_type=document_type).items():
+            if value is not None:
+                condition = pc.equal(self.documents[name], value)
+                mask = condition if mask is None else pc.and_(mask, condition)
+        if source is not None and f"has_{source}" in self.documents.column_names:
+            condition = self.documents[f"has_{source}"]
+            mask = condition if mask is None else pc.and_(mask, condition)
+        return self.documents["row_id"] if mask is None else self.documents.filter(mask)["row_id"]
+
+    def select(self, source=None, pii_type=None, row_ids=None):
+        """
+        The spans of one source ('gretel' for the true spans), optionally only
+        those of a canonical type and in `row_ids`.
+        """
+        mask = None
+        conditions = []
+        if source is not None:
+            conditions.append(pc.equal(self.spans["source"], source))
+        if pii_type is not None:
+            conditions.append(pc.equal(self.spans["type_id"], TYPE_IDS[pii_type]))
+        if row_ids is not None:
+            conditions.append(pc.is_in(self.spans["row_id"], value_set=pa.array(row_ids, pa.int32())))
+        for condition in conditions:
+            mask = condition if mask is None else pc.and_(mask, condition)
+        return self.spans if mask is None else self.spans.filter(mask)
+
+    def mistakes(self, source, kind="fn", pii_type=None, document_type=None, mode="exact", iou_threshold=0.5, **filters):
+        """
+        The true spans `source` missed (kind 'fn') or its spans that match no
+        true span (kind 'fp'), in documents it has results for. E.g. all GCP
+        DATE false negatives in IT tickets:
+
+            store.mistakes("gcp", "fn", "date", document_type="IT support ticket")
+        """
+        if kind not in MISTAKE_KINDS:
+            raise ValueError(f"Invalid kind '{kind}'. Choose one of {MISTAKE_KINDS}")
+        row_ids = self.row_ids(document_type, source, **filters)
+        truth = self.select("gretel", pii_type, row_ids)
+        predicted = self.select(source, pii_type, row_ids)
+        wanted = truth if kind == "fn" else predicted
+        unmatched = []
+        for truth_rows, predicted_rows in self._by_document(truth, predicted):
+            matches = match_spans([span for _, span in truth_rows], [span for _, span in predicted_rows], mode, iou_threshold)
+            matched = {t for t, _ in matches} if kind == "fn" else {p for _, p in matches}
+            rows = truth_rows if kind == "fn" else predicted_rows
+            unmatched.extend(index for i, (index, _) in enumerate(rows) if i not in matched)
+        return wanted.take(pa.array(sorted(unmatched), pa.int64()))
+
+    def span_count_arrays(self, source, mode="exact", iou_threshold=0.5, **filters):
+        """
+        (documents x scored types) TP, FP and FN count arrays for `source`, as
+        `eval.score_counts` takes them.
+        """
+        row_ids = self.row_ids(source=source, **filters)
+        truth = self.select("gretel", row_ids=row_ids)
+        predicted = self.select(source, row_ids=row_ids)
+        counts = np.zeros((3, len(row_ids), NUM_SCORED), dtype=np.int64)
+        for doc, (truth_rows, predicted_rows) in enumerate(self._by_document(truth, predicted, row_ids)):
+            true_spans = [span for _, span in truth_rows if 0 <= span[2] < NUM_SCORED]
+            pred_spans = [span for _, span in predicted_rows if 0 <= span[2] < NUM_SCORED]
+            matches = match_spans(true_spans, pred_spans, mode, iou_threshold)
+            matched_true, matched_pred = {t for t, _ in matches}, {p for _, p in matches}
+            for t, (_, _, type_id) in enumerate(true_spans):
+                counts[0 if t in matched_true else 2, doc, type_id] += 1
+            for p, (_, _, type_id) in enumerate(pred_spans):
+                if p not in matched_pred:
+                    counts[1, doc, type_id] += 1
+        return counts[0], counts[1], counts[2]
+
+    def label_counts(self, **filters):
+        """Spans per source and canonical type, for the documents matching the filters."""
+        spans = self.select(row_ids=self.row_ids(**filters)) if filters else self.spans
+        counts = spans.group_by(["source", "type_id"]).aggregate([("row_id", "count")])
+        result = defaultdict(dict)
+        for source, type_id, count in zip(*(counts[name].to_pylist() for name in ("source", "type_id", "row_id_count"))):
+            result[source][CANONICAL_TYPES[type_id] if type_id >= 0 else "unknown"] = count
+        return dict(result)
+
+    def _by_document(self, truth, predicted, row_ids=None):
+        """
+        Yields, per document, the ((table index, (start, end, type id))) lists
+        of `truth` and `predicted`. With `row_ids`, one pair per id in that order.
+        """
+        groups = defaultdict(lambda: ([], []))
+        for side, table in enumerate((truth, predicted)):
+            columns = [table[name].to_pylist() for name in ("row_id", "start", "end", "type_id")]
+            for index, (row_id, start, end, type_id) in enumerate(zip(*columns)):
+                groups[row_id][side].append((index, (start, end, type_id)))
+        if row_ids is None:
+            yield from groups.values()
+        else:
+            for row_id in row_ids.to_pylist():
+                yield groups.get(row_id, ([], []))
+
+
+def print_spans(table, limit):
+    for span in table.slice(0, limit).to_pylist():
+        print(f"row {span['row_id']:>7}  {span['start']:>5}-{span['end']:<5} {span['label']:<22} {span['text']!r}")
+    if table.num_rows > limit:
+        print(f"... {table.num_rows - limit} more")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query the compact result store")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="Write the store for a results dataset")
+    build.add_argument("results", help="A merged results Parquet file or a hub dataset name")
+    build.add_argument("--output", default="store")
+    query = commands.add_parser("query", help="List the false negatives or false positives of a source")
+    query.add_argument("store")
+    query.add_argument("--source", required=True)
+    query.add_argument("--kind", choices=MISTAKE_KINDS, default="fn")
+    query.add_argument("--type", choices=SCORED_TYPES, default=None)
+    query.add_argument("--document-type", default=None)
+    query.add_argument("--mode", choices=MATCH_MODES, default="exact")
+    query.add_argument("--iou-threshold", type=float, default=0.5)
+    query.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        store = build_store(load_results(args.results), args.output)
+        print(f"Wrote {store.documents.num_rows} documents and {store.spans.num_rows} spans to {args.output}")
+    else:
+        store = ResultStore(args.store)
+        found = store.mistakes(args.source, args.kind, args.type, args.document_type, args.mode, args.iou_threshold)
+        print(f"{found.num_rows} {args.source} {args.kind.upper()}s")
+        print_spans(found, args.limit)
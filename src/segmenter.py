@@ -0,0 +1,91 @@
+SENTENCE_ENDS = (". ", "! ", "? ", "\n")
+
+
+def find_cut(text, start, limit):
+    """
+    Picks where a segment starting at `start` should end, at most at `limit`:
+    the last sentence end in the second half of the window, else the last
+    whitespace, else a hard cut at `limit`.
+    """
+    if limit >= len(text):
+        return len(text)
+    floor = start + (limit - start) // 2
+    best = max(text.rfind(end, floor, limit) for end in SENTENCE_ENDS)
+    if best != -1:
+        return best + 1
+    space = max(text.rfind(" ", floor, limit), text.rfind("\t", floor, limit))
+    if space != -1:
+        return space + 1
+    return limit
+
+
+def segment_text(text, max_chars, overlap=0):
+    """
+    Splits `text` into segments of at most `max_chars`, cut on sentence or
+    whitespace boundaries, with each segment repeating about `overlap`
+    characters of the previous one so entities on a cut are seen whole at
+    least once.
+
+    Returns:
+        A list of (offset, segment) tuples, where offset is the segment's start in `text`.
+    """
+    if len(text) <= max_chars:
+        return [(0, text)]
+    overlap = min(overlap, max_chars // 2)
+    segments = []
+    start = 0
+    while start < len(text):
+        end = find_cut(text, start, start + max_chars)
+        segments.append((start, text[start:end]))
+        if end >= len(text):
+            break
+        next_start = end - overlap
+        # Don't start the next segment in the middle of a word
+        space = text.find(" ", next_start, end)
+        next_start = space + 1 if space != -1 else next_start
+        start = max(next_start, start + 1)
+    return segments
+
+
+def split_documents(documents, max_chars, overlap=0):
+    """
+    Segments every document. Returns the flat list of segments, to send through
+    a batched call, and for each segment the (document index, offset) it came from.
+    """
+    segments, owners = [], []
+    for i, document in enumerate(documents):
+        for offset, segment in segment_text(document, max_chars, overlap):
+            segments.append(segment)
+            owners.append((i, offset))
+    return segments, owners
+
+
+def merge_segment_spans(segment_spans, document):
+    """
+    Maps span records found in segments back onto `document` and drops the
+    duplicates found twice in an overlap zone. Where two spans with the same
+    label overlap the longer one wins, since the other was likely cut short at
+    a segment edge.
+
+    Args:
+        segment_spans: A list of (offset, spans) tuples, one per segment.
+        document: The original, unsegmented document.
+    """
+    shifted = []
+    for offset, spans in segment_spans:
+        for span in spans:
+            span = dict(span, start=span["start"] + offset, end=span["end"] + offset)
+            span["text"] = document[span["start"]:span["end"]]
+            shifted.append(span)
+    if len(segment_spans) <= 1:
+        return shifted
+
+    kept = []
+    for span in sorted(shifted, key=lambda s: (s["start"] - s["end"], -(s["score"] or 0.0))):
+        duplicate = any(
+            other["label"] == span["label"] and span["start"] < other["end"] and other["start"] < span["end"]
+            for other in kept
+        )
+        if not duplicate:
+            kept.append(span)
+    return sorted(kept, key=lambda s: (s["start"], s["end"]))
@@ -0,0 +1,84 @@
+from collections import defaultdict
+
+MATCH_MODES = ('exact', 'partial', 'iou')
+
+
+def iou(a_start, a_end, b_start, b_end):
+    overlap = min(a_end, b_end) - max(a_start, b_start)
+    if overlap <= 0:
+        return 0.0
+    return overlap / (max(a_end, b_end) - min(a_start, b_start))
+
+
+def is_match(true_span, pred_span, mode, iou_threshold):
+    t_start, t_end, _ = true_span
+    p_start, p_end, _ = pred_span
+    if mode == 'exact':
+        return t_start == p_start and t_end == p_end
+    if mode == 'partial':
+        return p_start < t_end and p_end > t_start
+    return iou(t_start, t_end, p_start, p_end) >= iou_threshold
+
+
+def match_spans(true_spans, pred_spans, mode='exact', iou_threshold=0.5, match_labels=True):
+    """
+    One-to-one matching of predicted spans to true spans, each given as
+    (start, end, label) tuples. Both lists are sorted by start and swept
+    together, only spans that overlap the current true span are considered, so
+    the cost is O(n log n) plus the number of overlapping pairs. Each true span
+    takes the unmatched overlapping prediction with the highest IoU.
+
+    Returns:
+        A list of (true_index, pred_index) pairs, indices into the input lists.
+    """
+    if mode not in MATCH_MODES:
+        raise ValueError(f"Invalid match mode '{mode}'. Choose one of {MATCH_MODES}")
+
+    true_order = sorted(range(len(true_spans)), key=lambda i: true_spans[i][0])
+    pred_order = sorted(range(len(pred_spans)), key=lambda i: pred_spans[i][0])
+
+    matches = []
+    matched_preds = set()
+    active = []
+    next_pred = 0
+    for t in true_order:
+        t_start, t_end, t_label = true_spans[t]
+        while next_pred < len(pred_order) and pred_spans[pred_order[next_pred]][0] < t_end:
+            active.append(pred_order[next_pred])
+            next_pred += 1
+        # True spans arrive in start order, so a prediction ending before this one
+        # starts can't overlap any later true span either
+        active = [p for p in active if pred_spans[p][1] > t_start and p not in matched_preds]
+
+        best, best_iou = None, -1.0
+        for p in active:
+            p_start, p_end, p_label = pred_spans[p]
+            if match_labels and p_label != t_label:
+                continue
+            if not is_match(true_spans[t], pred_spans[p], mode, iou_threshold):
+                continue
+            score = iou(t_start, t_end, p_start, p_end)
+            if score > best_iou:
+                best, best_iou = p, score
+        if best is not None:
+            matches.append((t, best))
+            matched_preds.add(best)
+    return matches
+
+
+def span_counts(true_spans, pred_spans, mode='exact', iou_threshold=0.5, match_labels=True):
+    """
+    Per-label TP/FP/FN counts for one document. True positives and false
+    negatives are counted under the true span's label, false positives under
+    the predicted label.
+    """
+    counts = defaultdict(lambda: [0, 0, 0])
+    matches = match_spans(true_spans, pred_spans, mode, iou_threshold, match_labels)
+    matched_true = {t for t, _ in matches}
+    matched_pred = {p for _, p in matches}
+    for t, (_, _, label) in enumerate(true_spans):
+        counts[label][0 if t in matched_true else 2] += 1
+    for p, (_, _, label) in enumerate(pred_spans):
+        if p not in matched_pred:
+            counts[label][1] += 1
+    return counts
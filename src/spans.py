@@ -0,0 +1,55 @@
+# One detected entity, see `make_span`. Offsets are Python string (code point)
+# indices into the document, `end` is exclusive. The Arrow type for span
+# columns is `checkpoint.SPAN_LIST`.
+
+# DLP reports a Likelihood enum instead of a confidence score
+GCP_LIKELIHOOD_SCORES = {
+    0: 0.0,  # LIKELIHOOD_UNSPECIFIED
+    1: 0.1,  # VERY_UNLIKELY
+    2: 0.3,  # UNLIKELY
+    3: 0.5,  # POSSIBLE
+    4: 0.7,  # LIKELY
+    5: 0.9,  # VERY_LIKELY
+}
+
+
+def make_span(provider, start, end, label, score, text):
+    return {
+        "provider": provider,
+        "start": start,
+        "end": end,
+        "label": label,
+        "score": score,
+        "text": text,
+    }
+
+
+def comprehend_spans(response, document):
+    """Spans from a Comprehend DetectPiiEntities response for `document`."""
+    return [
+        make_span("aws", entity["BeginOffset"], entity["EndOffset"], entity["Type"],
+                  entity["Score"], document[entity["BeginOffset"]:entity["EndOffset"]])
+        for entity in response["Entities"]
+    ]
+
+
+def azure_spans(doc):
+    """Spans from an Azure RecognizePiiEntitiesResult."""
+    return [
+        make_span("azure", entity.offset, entity.offset + entity.length,
+                  entity.category, entity.confidence_score, entity.text)
+        for entity in doc.entities
+    ]
+
+
+def gcp_spans(response, document):
+    """Spans from a DLP InspectContentResponse for `document`."""
+    spans = []
+    for finding in response.result.findings:
+        codepoints = finding.location.codepoint_range
+        spans.append(make_span(
+            "gcp", codepoints.start, codepoints.end, finding.info_type.name,
+            GCP_LIKELIHOOD_SCORES.get(int(finding.likelihood), 0.0),
+            document[codepoints.start:codepoints.end]
+        ))
+    return spans
@@ -0,0 +1,113 @@
+# Canonical entity types. The first ones are the Gretel labels the study scores,
+# so their integer ids double as column indexes for the per-type arrays in eval.py.
+SCORED_TYPES = ['date', 'email', 'name', 'phone_number', 'street_address']
+OTHER_TYPES = ['ssn', 'itin', 'credit_card_number', 'location']
+CANONICAL_TYPES = SCORED_TYPES + OTHER_TYPES
+TYPE_IDS = {pii_type: i for i, pii_type in enumerate(CANONICAL_TYPES)}
+NUM_SCORED = len(SCORED_TYPES)
+
+# Provider label -> canonical type. Organizations count as names, as in the study
+PROVIDER_LABELS = {
+    'azure': {
+        'Person': 'name',
+        'PersonType': 'name',
+        'Organization': 'name',
+        'Address': 'street_address',
+        'Email': 'email',
+        'DateTime': 'date',
+        'Date': 'date',
+        'PhoneNumber': 'phone_number',
+        'USSocialSecurityNumber': 'ssn',
+        'USIndividualTaxpayerIdentification': 'itin',
+        'CreditCardNumber': 'credit_card_number',
+    },
+    'gcp': {
+        'PERSON_NAME': 'name',
+        'ORGANIZATION_NAME': 'name',
+        'STREET_ADDRESS': 'street_address',
+        'EMAIL_ADDRESS': 'email',
+        'DATE': 'date',
+        'PHONE_NUMBER': 'phone_number',
+        'US_SOCIAL_SECURITY_NUMBER': 'ssn',
+        'US_INDIVIDUAL_TAXPAYER_IDENTIFICATION_NUMBER': 'itin',
+        'CREDIT_CARD_NUMBER': 'credit_card_number',
+        'LOCATION': 'location',
+    },
+    'aws': {
+        'NAME': 'name',
+        'ADDRESS': 'street_address',
+        'EMAIL': 'email',
+        'DATE_TIME': 'date',
+        'PHONE': 'phone_number',
+        'SSN': 'ssn',
+        'CREDIT_DEBIT_NUMBER': 'credit_card_number',
+    },
+    # Gretel labels are already canonical names
+    'gretel': {pii_type: pii_type for pii_type in CANONICAL_TYPES},
+}
+# The local detector uses the DLP info type names, merged ensemble spans the canonical ones
+PROVIDER_LABELS['local'] = PROVIDER_LABELS['gcp']
+PROVIDER_LABELS['ensemble'] = PROVIDER_LABELS['gretel']
+
+# Provider label -> canonical type for the labels a request may ask for, where the provider
+# takes other names than it returns. Azure reports dates as DateTime but filters on Date, and
+# PersonType isn't a PiiEntityCategory, so neither may go in categories_filter
+REQUEST_LABELS = dict(PROVIDER_LABELS)
+REQUEST_LABELS['azure'] = {
+    'Person': 'name',
+    'Organization': 'name',
+    'Address': 'street_address',
+    'Email': 'email',
+    'Date': 'date',
+    'PhoneNumber': 'phone_number',
+    'USSocialSecurityNumber': 'ssn',
+    'USIndividualTaxpayerIdentification': 'itin',
+    'CreditCardNumber': 'credit_card_number',
+}
+
+UNKNOWN = -1
+
+# Compiled once: provider -> {label: type id}
+LABEL_IDS = {
+    provider: {label: TYPE_IDS[pii_type] for label, pii_type in labels.items()}
+    for provider, labels in PROVIDER_LABELS.items()
+}
+
+
+def type_id(provider, label):
+    """
+    The canonical type id of a provider label, or UNKNOWN. Labels missing from
+    the table are matched on their lower-cased name (e.g. 'DATE' -> 'date'),
+    and the answer is remembered.
+    """
+    ids = LABEL_IDS[provider]
+    found = ids.get(label)
+    if found is None:
+        found = ids[label] = TYPE_IDS.get(label.lower(), UNKNOWN)
+    return found
+
+
+def type_ids(provider, labels):
+    ids = LABEL_IDS[provider]
+    return [ids[label] if label in ids else type_id(provider, label) for label in labels]
+
+
+def canonical_type(provider, label):
+    """The canonical type name of a provider label, or None."""
+    found = type_id(provider, label)
+    return CANONICAL_TYPES[found] if found != UNKNOWN else None
+
+
+def provider_labels(provider, pii_types=SCORED_TYPES):
+    """
+    The provider labels that map to any of `pii_types`, e.g. the DLP info types
+    to request for the scored types.
+    """
+    wanted = set(pii_types)
+    return [label for label, pii_type in PROVIDER_LABELS[provider].items() if pii_type in wanted]
+
+
+def request_labels(provider, pii_types=SCORED_TYPES):
+    """The labels to ask `provider` for to get `pii_types`, e.g. Azure's categories_filter."""
+    wanted = set(pii_types)
+    return [label for label, pii_type in REQUEST_LABELS[provider].items() if pii_type in wanted]